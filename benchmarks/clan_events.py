@@ -0,0 +1,185 @@
+"""
+Kafka bytes sent by the clan tracker, per-type messages vs coalesced events.
+
+Builds synthetic clan responses, replays `--polls` polls in which a share of
+clans see donations and member churn, and runs them through
+`ClanTracker._process_clan` with the legacy per-type messages, coalesced
+events with snapshots and coalesced events without snapshots. Bytes/sec
+assumes one poll every `--interval` seconds, as the tracker runs.
+
+    python -m benchmarks.clan_events --clans 5000 --active 0.6
+"""
+import argparse
+import copy
+import random
+
+import orjson
+
+from benchmarks.common import CountingProducer, write_results
+from benchmarks.player_diff import _tag
+from bot.clan.track import ClanTracker
+from utility.tracing import Tracer
+
+ROLES = ['member', 'admin', 'coLeader', 'leader']
+
+
+def make_member(rng: random.Random) -> dict:
+    return {
+        'tag': _tag(rng),
+        'name': f'player{rng.randrange(10**6)}',
+        'role': rng.choice(ROLES),
+        'townHallLevel': rng.randint(8, 17),
+        'expLevel': rng.randint(50, 300),
+        'league': {
+            'id': 29000000 + rng.randint(0, 22),
+            'name': 'Master League I',
+            'iconUrls': {
+                'small': 'https://api-assets.clashofclans.com/leagues/36/R2zmhyqQ0_lKcDR5EyghXCxgyC9mm4mVMIjAbmGoZtw.png',
+                'tiny': 'https://api-assets.clashofclans.com/leagues/36/R2zmhyqQ0_lKcDR5EyghXCxgyC9mm4mVMIjAbmGoZtw.png',
+            },
+        },
+        'trophies': rng.randint(1000, 6000),
+        'builderBaseTrophies': rng.randint(1000, 5000),
+        'clanRank': 1,
+        'previousClanRank': 1,
+        'donations': rng.randint(0, 2000),
+        'donationsReceived': rng.randint(0, 2000),
+        'playerHouse': {'elements': [{'type': 'ground', 'id': 82000000}]},
+    }
+
+
+def make_clan(rng: random.Random) -> dict:
+    members = [make_member(rng) for _ in range(rng.randint(30, 50))]
+    return {
+        'tag': _tag(rng),
+        'name': f'clan{rng.randrange(10**6)}',
+        'type': 'inviteOnly',
+        'description': 'Active war clan, 2 wars a week, CWL every season. '
+        'Donate what is requested, attack in every war.',
+        'location': {
+            'id': 32000006,
+            'name': 'International',
+            'isCountry': False,
+        },
+        'isFamilyFriendly': False,
+        'badgeUrls': {
+            'small': 'https://api-assets.clashofclans.com/badges/70/example.png',
+            'large': 'https://api-assets.clashofclans.com/badges/512/example.png',
+            'medium': 'https://api-assets.clashofclans.com/badges/200/example.png',
+        },
+        'clanLevel': rng.randint(1, 30),
+        'clanPoints': rng.randint(10000, 60000),
+        'clanBuilderBasePoints': rng.randint(10000, 60000),
+        'clanCapitalPoints': rng.randint(1000, 5000),
+        'capitalLeague': {'id': 85000015, 'name': 'Master League I'},
+        'requiredTrophies': 2000,
+        'warFrequency': 'always',
+        'warWinStreak': rng.randint(0, 20),
+        'warWins': rng.randint(0, 1000),
+        'warTies': rng.randint(0, 50),
+        'warLosses': rng.randint(0, 300),
+        'isWarLogPublic': rng.random() > 0.05,
+        'warLeague': {'id': 48000015, 'name': 'Master League I'},
+        'members': len(members),
+        'memberList': members,
+        'labels': [{'id': 56000000, 'name': 'Clan Wars'}],
+        'requiredBuilderBaseTrophies': 0,
+        'requiredTownhallLevel': 10,
+        'clanCapital': {'capitalHallLevel': 10, 'districts': []},
+        'chatLanguage': {'id': 75000000, 'name': 'English', 'languageCode': 'EN'},
+    }
+
+
+def poll(rng: random.Random, clan: dict, active: float) -> dict:
+    """The clan one poll later."""
+    clan = copy.deepcopy(clan)
+    if rng.random() > active:
+        return clan
+    members = clan['memberList']
+    for member in rng.sample(members, k=min(len(members), rng.randint(1, 5))):
+        member['donations'] += rng.randint(1, 40)
+        member['donationsReceived'] += rng.randint(0, 40)
+    if rng.random() < 0.1:
+        members.pop(rng.randrange(len(members)))
+        members.append(make_member(rng))
+    clan['members'] = len(members)
+    return clan
+
+
+def make_tracker(
+    coalesce: bool, snapshots: bool, tracer: Tracer = None
+) -> ClanTracker:
+    # skip Tracking.__init__, which fetches remote settings
+    tracker = ClanTracker.__new__(ClanTracker)
+    tracker.tracer = tracer or Tracer(enabled=False)
+    tracker.kafka = CountingProducer()
+    tracker.message_count = 0
+    tracker.message_bytes = 0
+    tracker.clan_cache = {}
+    tracker.last_private_warlog_warn = {}
+    tracker.coalesce_events = coalesce
+    tracker.event_snapshots = snapshots
+    return tracker
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--clans', type=int, default=5_000)
+    parser.add_argument('--polls', type=int, default=5)
+    parser.add_argument(
+        '--active',
+        type=float,
+        default=0.6,
+        help='share of clans with donations in a poll',
+    )
+    parser.add_argument('--interval', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    clans = [make_clan(rng) for _ in range(args.clans)]
+    polls = [[orjson.dumps(clan) for clan in clans]]
+    for _ in range(args.polls):
+        clans = [poll(rng, clan, args.active) for clan in clans]
+        polls.append([orjson.dumps(clan) for clan in clans])
+
+    results = {}
+    for name, coalesce, snapshots in (
+        ('per_type', False, True),
+        ('coalesced', True, True),
+        ('coalesced_no_snapshots', True, False),
+    ):
+        tracker = make_tracker(coalesce, snapshots)
+        for number, responses in enumerate(polls):
+            if number == 1:
+                tracker.kafka.reset()
+            for i, raw_clan in enumerate(responses):
+                tracker._process_clan(f'#C{i}', raw_clan)
+        per_poll = tracker.kafka.bytes / args.polls
+        results[name] = {
+            'messages_per_poll': tracker.kafka.messages / args.polls,
+            'bytes_per_poll': per_poll,
+            'bytes_per_sec': per_poll / args.interval,
+        }
+    for name in ('coalesced', 'coalesced_no_snapshots'):
+        results[name]['reduction'] = (
+            results['per_type']['bytes_per_sec']
+            / results[name]['bytes_per_sec']
+        )
+
+    write_results(
+        'clan_events',
+        params={
+            'clans': args.clans,
+            'polls': args.polls,
+            'active': args.active,
+            'seed': args.seed,
+        },
+        results=results,
+        output=args.output,
+    )
+
+
+if __name__ == '__main__':
+    main()
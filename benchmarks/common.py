@@ -0,0 +1,104 @@
+import platform
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+import orjson
+import pendulum as pend
+
+
+class CountingProducer:
+    """Kafka producer stand-in that only counts what would have been sent."""
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.topics = defaultdict(int)
+
+    def send(self, topic, value=None, key=None, timestamp_ms=None, **kwargs):
+        self.messages += 1
+        self.bytes += len(value or b'') + len(key or b'')
+        self.topics[topic] += 1
+
+    def reset(self):
+        self.messages = 0
+        self.bytes = 0
+        self.topics.clear()
+
+
+def git_revision() -> str:
+    """Short commit hash of the working tree, suffixed with -dirty if modified."""
+    try:
+        revision = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], text=True
+        ).strip()
+        dirty = subprocess.run(
+            ['git', 'diff', '--quiet', 'HEAD', '--', '*.py'],
+        ).returncode
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return f'{revision}-dirty' if dirty else revision
+
+
+def best_of(repeat: int, func):
+    """Run `func` `repeat` times and return (best seconds, last result)."""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def write_results(name: str, params: dict, results: dict, output: str = None):
+    """
+    Print benchmark results and optionally write them to a JSON file.
+
+    The file carries the commit and interpreter so runs on different commits
+    can be compared with `compare_results`.
+    """
+    document = {
+        'benchmark': name,
+        'commit': git_revision(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'timestamp': int(pend.now(tz=pend.UTC).timestamp()),
+        'params': params,
+        'results': results,
+    }
+    print(orjson.dumps(document, option=orjson.OPT_INDENT_2).decode('utf-8'))
+    if output:
+        with open(output, 'wb') as file:
+            file.write(orjson.dumps(document, option=orjson.OPT_INDENT_2))
+    return document
+
+
+def compare_results(previous_path: str, current: dict):
+    """Print the relative change of every numeric result against a previous run."""
+    with open(previous_path, 'rb') as file:
+        previous = orjson.loads(file.read())
+
+    if previous.get('params') != current.get('params'):
+        print('warning: benchmark parameters differ between runs')
+
+    def walk(old, new, prefix=''):
+        for key, value in new.items():
+            name = f'{prefix}{key}'
+            old_value = old.get(key) if isinstance(old, dict) else None
+            if isinstance(value, dict):
+                walk(old_value or {}, value, prefix=f'{name}.')
+            elif isinstance(value, (int, float)) and isinstance(
+                old_value, (int, float)
+            ):
+                change = (
+                    (value - old_value) / old_value * 100 if old_value else 0.0
+                )
+                print(
+                    f'{name:<50} {old_value:>14.2f} -> {value:>14.2f} ({change:+.1f}%)'
+                )
+
+    print(f"{previous.get('commit')} -> {current.get('commit')}")
+    walk(previous.get('results', {}), current.get('results', {}))
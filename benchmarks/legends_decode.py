@@ -0,0 +1,73 @@
+"""
+Decode throughput of legends player responses on a single core.
+
+`orjson_subset` is the old fetch path: parse the full body with orjson, then
+keep the nine legends fields. `player_decoder` is the typed msgspec decode
+the tracker uses now, which only materializes the compared fields and keeps
+clan/league/heroes/equipment as raw slices.
+
+    python -m benchmarks.legends_decode --responses 20000
+"""
+import argparse
+import random
+
+import orjson
+
+from benchmarks.common import best_of, write_results
+from benchmarks.legends_memory import LEGACY_FIELDS
+from benchmarks.player_diff import make_player
+from bot.legends.classes import player_decoder
+
+
+def orjson_subset(responses: list[bytes]):
+    for body in responses:
+        response = orjson.loads(body)
+        {key: response.get(key) for key in LEGACY_FIELDS}
+
+
+def typed_decode(responses: list[bytes]):
+    decode = player_decoder.decode
+    for body in responses:
+        decode(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--responses', type=int, default=20_000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    responses = [
+        orjson.dumps(make_player(rng, legend=True))
+        for _ in range(args.responses)
+    ]
+    mib = sum(len(r) for r in responses) / 2**20
+
+    results = {}
+    for name, func in (
+        ('orjson_subset', orjson_subset),
+        ('player_decoder', typed_decode),
+    ):
+        seconds, _ = best_of(args.repeat, lambda: func(responses))
+        results[name] = {
+            'decodes_per_sec': len(responses) / seconds,
+            'mib_per_sec': mib / seconds,
+        }
+    results['speedup'] = (
+        results['player_decoder']['decodes_per_sec']
+        / results['orjson_subset']['decodes_per_sec']
+    )
+
+    write_results(
+        'legends_decode',
+        params={'responses': args.responses, 'seed': args.seed},
+        results=results,
+        output=args.output,
+    )
+
+
+if __name__ == '__main__':
+    main()
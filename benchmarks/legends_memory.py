@@ -0,0 +1,107 @@
+"""
+Heap held by the legends tracker cache.
+
+Decodes synthetic legend player responses into the representation the
+tracker caches and reports retained bytes per player, extrapolated to the
+requested number of cached players. `subset_dict` is what the tracker used
+to keep in `Player.raw_data` before the slotted model; the old model also
+built Heroes/Equipment/Clan/League objects on top of it, so it is a lower
+bound for the legacy heap.
+
+    python -m benchmarks.legends_memory --players 500000
+"""
+import argparse
+import gc
+import random
+import tracemalloc
+
+import orjson
+from msgspec.json import decode
+
+from benchmarks.common import write_results
+from benchmarks.player_diff import make_player
+from bot.legends.classes import Player
+
+LEGACY_FIELDS = [
+    'name',
+    'tag',
+    'trophies',
+    'attackWins',
+    'defenseWins',
+    'heroes',
+    'heroEquipment',
+    'clan',
+    'league',
+]
+
+
+def build_pool(size: int, seed: int) -> list[bytes]:
+    rng = random.Random(seed)
+    return [orjson.dumps(make_player(rng, legend=True)) for _ in range(size)]
+
+
+def subset_dict(response: bytes):
+    response = orjson.loads(response)
+    return {key: response.get(key) for key in LEGACY_FIELDS}
+
+
+def player_struct(response: bytes):
+    return decode(response, type=Player)
+
+
+def retained_bytes(pool: list[bytes], players: int, build) -> int:
+    gc.collect()
+    tracemalloc.start()
+    try:
+        cache = {}
+        for i in range(players):
+            cache[f'#P{i}'] = build(pool[i % len(pool)])
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del cache
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--players', type=int, default=500_000)
+    parser.add_argument(
+        '--sample',
+        type=int,
+        default=50_000,
+        help='players actually decoded; the result is scaled to --players',
+    )
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    sample = min(args.sample, args.players)
+    pool = build_pool(1_000, args.seed)
+    results = {}
+    for name, build in (
+        ('subset_dict', subset_dict),
+        ('player_struct', player_struct),
+    ):
+        size = retained_bytes(pool, sample, build)
+        per_player = size / sample
+        results[name] = {
+            'bytes_per_player': per_player,
+            'mib_for_players': per_player * args.players / 2**20,
+        }
+    results['reduction'] = (
+        results['subset_dict']['bytes_per_player']
+        / results['player_struct']['bytes_per_player']
+    )
+
+    write_results(
+        'legends_memory',
+        params={'players': args.players, 'sample': sample, 'seed': args.seed},
+        results=results,
+        output=args.output,
+    )
+
+
+if __name__ == '__main__':
+    main()
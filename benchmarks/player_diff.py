@@ -0,0 +1,511 @@
+"""
+Replayable benchmark for the player diff path.
+
+A corpus is a JSON-lines file of (previous, current) player responses, either
+generated synthetically or recorded from the Redis snapshot cache the player
+tracker keeps. Running the corpus through `get_player_changes` and
+`find_and_list_changes` reports players/sec, Mongo ops and Kafka bytes
+emitted and allocated bytes per player.
+
+    python -m benchmarks.player_diff generate --players 20000 --output corpus.jsonl
+    python -m benchmarks.player_diff record --players 20000 --interval 120 --output corpus.jsonl
+    python -m benchmarks.player_diff run --corpus corpus.jsonl --output results.json
+    python -m benchmarks.player_diff run --corpus corpus.jsonl --compare results.json
+"""
+import argparse
+import asyncio
+import copy
+import random
+import time
+import tracemalloc
+from collections import defaultdict
+
+import orjson
+import snappy
+
+from benchmarks.common import (
+    CountingProducer,
+    best_of,
+    compare_results,
+    write_results,
+)
+from bot.player.utils import find_and_list_changes, get_player_changes
+
+MIXES = {
+    'donations': 0.45,
+    'legends': 0.25,
+    'upgrades': 0.2,
+    'clan': 0.1,
+}
+
+TROOPS = [
+    'Barbarian',
+    'Archer',
+    'Goblin',
+    'Giant',
+    'Wall Breaker',
+    'Balloon',
+    'Wizard',
+    'Healer',
+    'Dragon',
+    'P.E.K.K.A',
+    'Minion',
+    'Hog Rider',
+    'Valkyrie',
+    'Golem',
+    'Witch',
+    'Lava Hound',
+    'Bowler',
+    'Baby Dragon',
+    'Miner',
+    'Super Barbarian',
+    'Super Archer',
+    'Super Wall Breaker',
+    'Super Giant',
+    'Ice Golem',
+    'Electro Dragon',
+    'Yeti',
+    'Dragon Rider',
+    'Electro Titan',
+    'Root Rider',
+    'Headhunter',
+    'Apprentice Warden',
+    'Wall Wrecker',
+    'Battle Blimp',
+    'Stone Slammer',
+    'Siege Barracks',
+    'Log Launcher',
+    'Flame Flinger',
+    'Battle Drill',
+    'L.A.S.S.I',
+    'Mighty Yak',
+]
+SPELLS = [
+    'Lightning Spell',
+    'Healing Spell',
+    'Rage Spell',
+    'Jump Spell',
+    'Freeze Spell',
+    'Clone Spell',
+    'Invisibility Spell',
+    'Recall Spell',
+    'Poison Spell',
+    'Earthquake Spell',
+    'Haste Spell',
+    'Skeleton Spell',
+    'Bat Spell',
+    'Overgrowth Spell',
+]
+HEROES = {
+    'Barbarian King': [
+        'Barbarian Puppet',
+        'Rage Vial',
+        'Earthquake Boots',
+        'Giant Gauntlet',
+    ],
+    'Archer Queen': [
+        'Archer Puppet',
+        'Invisibility Vial',
+        'Giant Arrow',
+        'Frozen Arrow',
+    ],
+    'Grand Warden': ['Eternal Tome', 'Life Gem', 'Rage Gem', 'Healing Tome'],
+    'Royal Champion': [
+        'Seeking Shield',
+        'Royal Gem',
+        'Hog Rider Puppet',
+        'Haste Vial',
+    ],
+    'Minion Prince': ['Henchmen Puppet', 'Dark Orb'],
+}
+ACHIEVEMENTS = [
+    'Gold Grab',
+    'Elixir Escapade',
+    'Heroic Heist',
+    'Games Champion',
+    'Aggressive Capitalism',
+    'Well Seasoned',
+    'Nice and Tidy',
+    'War League Legend',
+    'Wall Buster',
+    'Bigger Coffers',
+    'Get those Goblins!',
+    'Bigger & Better',
+    'Empire Builder',
+    'Gold Grab II',
+    'Sweet Victory!',
+    'Unbreakable',
+    'Friend in Need',
+    'Mortar Mauler',
+    'Humiliator',
+    'Union Buster',
+    'Conqueror',
+    'War Hero',
+    'Keep Your Account Safe!',
+    'X-Bow Exterminator',
+    'Firefighter',
+    'Anti-Artillery',
+    'Sharing is caring',
+    'Master Engineering',
+    'Hidden Treasures',
+    'Champion Builder',
+    'Superb Work',
+    'Siege Sharer',
+    'Counterspell',
+    'Monolith Masher',
+]
+
+
+def _tag(rng: random.Random) -> str:
+    return '#' + ''.join(rng.choice('0289PYLQGRJCUV') for _ in range(9))
+
+
+def make_player(rng: random.Random, legend: bool = False) -> dict:
+    """Build a player response shaped like the /players endpoint."""
+    th = rng.randint(12, 17)
+    trophies = rng.randint(5000, 6200) if legend else rng.randint(1500, 4899)
+    equipment = []
+    heroes = []
+    for hero, gear in HEROES.items():
+        hero_gear = [
+            {
+                'name': name,
+                'level': rng.randint(1, 27),
+                'maxLevel': 27,
+                'village': 'home',
+            }
+            for name in gear
+        ]
+        equipment.extend(hero_gear)
+        heroes.append(
+            {
+                'name': hero,
+                'level': rng.randint(40, 100),
+                'maxLevel': 100,
+                'equipment': hero_gear[:2],
+                'village': 'home',
+            }
+        )
+    return {
+        'tag': _tag(rng),
+        'name': f'player{rng.randint(0, 10**6)}',
+        'townHallLevel': th,
+        'townHallWeaponLevel': rng.randint(1, 5),
+        'expLevel': rng.randint(150, 300),
+        'trophies': trophies,
+        'bestTrophies': trophies + rng.randint(0, 400),
+        'warStars': rng.randint(100, 3000),
+        'attackWins': rng.randint(0, 200),
+        'defenseWins': rng.randint(0, 20),
+        'builderHallLevel': 10,
+        'builderBaseTrophies': rng.randint(2000, 5000),
+        'bestBuilderBaseTrophies': 5000,
+        'role': rng.choice(['member', 'admin', 'coLeader']),
+        'warPreference': rng.choice(['in', 'out']),
+        'donations': rng.randint(0, 2000),
+        'donationsReceived': rng.randint(0, 2000),
+        'clanCapitalContributions': rng.randint(0, 10**7),
+        'clan': {
+            'tag': _tag(rng),
+            'name': 'Some Clan',
+            'clanLevel': rng.randint(1, 30),
+            'badgeUrls': {
+                'small': 'https://api-assets.clashofclans.com/badges/70/x.png',
+                'large': 'https://api-assets.clashofclans.com/badges/512/x.png',
+                'medium': 'https://api-assets.clashofclans.com/badges/200/x.png',
+            },
+        },
+        'league': {
+            'id': 29000022 if legend else 29000015,
+            'name': 'Legend League' if legend else 'Titan League II',
+            'iconUrls': {
+                'small': 'https://api-assets.clashofclans.com/leagues/72/x.png',
+                'tiny': 'https://api-assets.clashofclans.com/leagues/36/x.png',
+                'medium': 'https://api-assets.clashofclans.com/leagues/288/x.png',
+            },
+        },
+        'legendStatistics': {
+            'legendTrophies': rng.randint(0, 10000),
+            'currentSeason': {'rank': 1, 'trophies': trophies},
+        },
+        'achievements': [
+            {
+                'name': name,
+                'stars': rng.randint(0, 3),
+                'value': rng.randint(0, 10**8),
+                'target': 10**6,
+                'info': f'Complete {name}',
+                'completionInfo': None,
+                'village': 'home',
+            }
+            for name in ACHIEVEMENTS
+        ],
+        'playerHouse': {'elements': [{'type': 'ground', 'id': 82000000}]},
+        'labels': [{'id': 57000000, 'name': 'Clan Wars'}],
+        'troops': [
+            {
+                'name': name,
+                'level': rng.randint(1, 12),
+                'maxLevel': 12,
+                'village': 'home',
+            }
+            for name in TROOPS
+        ],
+        'heroes': heroes,
+        'heroEquipment': equipment,
+        'spells': [
+            {
+                'name': name,
+                'level': rng.randint(1, 11),
+                'maxLevel': 11,
+                'village': 'home',
+            }
+            for name in SPELLS
+        ],
+    }
+
+
+def mutate(rng: random.Random, player: dict, mix: str) -> dict:
+    """Return a copy of `player` with a change typical for `mix` applied."""
+    current = copy.deepcopy(player)
+    if mix == 'donations':
+        current['donations'] += rng.randint(1, 50)
+        if rng.random() < 0.6:
+            current['donationsReceived'] += rng.randint(1, 50)
+    elif mix == 'legends':
+        if rng.random() < 0.6:
+            attacks = rng.choice([1, 1, 1, 2])
+            current['trophies'] += (
+                40 * attacks if rng.random() < 0.5 else rng.randint(5, 39)
+            )
+            current['attackWins'] += attacks
+        else:
+            current['trophies'] -= rng.randint(0, 40)
+            current['defenseWins'] += 1 if rng.random() < 0.2 else 0
+    elif mix == 'upgrades':
+        section = rng.choice(['troops', 'spells', 'heroes', 'heroEquipment'])
+        item = rng.choice(current[section])
+        item['level'] += 1
+        if rng.random() < 0.3:
+            current['townHallLevel'] += 1
+    elif mix == 'clan':
+        current['clan']['tag'] = _tag(rng)
+        current['clan']['name'] = 'Another Clan'
+        current['role'] = 'member'
+    for achievement in current['achievements']:
+        if (
+            achievement['name'] in ('Gold Grab', 'Elixir Escapade')
+            and rng.random() < 0.3
+        ):
+            achievement['value'] += rng.randint(1000, 500000)
+    return current
+
+
+def generate(players: int, seed: int, mixes: dict):
+    rng = random.Random(seed)
+    names = list(mixes)
+    weights = [mixes[name] for name in names]
+    for _ in range(players):
+        mix = rng.choices(names, weights=weights)[0]
+        previous = make_player(rng, legend=(mix == 'legends'))
+        yield {
+            'mix': mix,
+            'previous': previous,
+            'current': mutate(rng, previous, mix),
+        }
+
+
+async def record(players: int, interval: int, match: str):
+    """Pair two snapshots of the player cache taken `interval` seconds apart."""
+    from utility.config import Config, TrackingType
+
+    cache = Config(config_type=TrackingType.BOT_PLAYER).get_redis_client()
+    tags = []
+    async for key in cache.scan_iter(match=match, count=10_000):
+        tags.append(key)
+        if len(tags) >= players:
+            break
+
+    before = await cache.mget(keys=tags)
+    await asyncio.sleep(interval)
+    after = await cache.mget(keys=tags)
+    await cache.aclose()
+
+    for previous, current in zip(before, after):
+        if previous is None or current is None or previous == current:
+            continue
+        yield {
+            'mix': 'recorded',
+            'previous': orjson.loads(snappy.decompress(previous)),
+            'current': orjson.loads(snappy.decompress(current)),
+        }
+
+
+def load_corpus(path: str) -> list[dict]:
+    with open(path, 'rb') as file:
+        return [orjson.loads(line) for line in file if line.strip()]
+
+
+def run_diff_only(pairs: list[dict]):
+    for pair in pairs:
+        get_player_changes(pair['previous'], pair['current'])
+
+
+def run_full(pairs: list[dict], producer: CountingProducer):
+    ops = defaultdict(int)
+    for pair in pairs:
+        bulk_db_changes, auto_complete, bulk_insert, bulk_clan_changes = (
+            [],
+            [],
+            [],
+            [],
+        )
+        find_and_list_changes(
+            producer=producer,
+            response=pair['current'],
+            previous_response=pair['previous'],
+            bulk_db_changes=bulk_db_changes,
+            auto_complete=auto_complete,
+            bulk_insert=bulk_insert,
+            bulk_clan_changes=bulk_clan_changes,
+        )
+        ops['player_stats'] += len(bulk_db_changes)
+        ops['player_search'] += len(auto_complete)
+        ops['player_history'] += len(bulk_insert)
+        ops['clan_stats'] += len(bulk_clan_changes)
+    return ops
+
+
+def allocated_per_player(pairs: list[dict]) -> float:
+    """Mean peak of traced allocations while diffing a single player."""
+    producer = CountingProducer()
+    tracemalloc.start()
+    total = 0
+    try:
+        for pair in pairs:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            run_full([pair], producer)
+            total += tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+    return total / len(pairs) if pairs else 0.0
+
+
+def measure(pairs: list[dict], repeat: int) -> dict:
+    producer = CountingProducer()
+    diff_seconds, _ = best_of(repeat, lambda: run_diff_only(pairs))
+
+    def full():
+        producer.reset()
+        return run_full(pairs, producer)
+
+    full_seconds, ops = best_of(repeat, full)
+    count = len(pairs)
+    return {
+        'players': count,
+        'diff_players_per_sec': count / diff_seconds if diff_seconds else 0.0,
+        'full_players_per_sec': count / full_seconds if full_seconds else 0.0,
+        'mongo_ops': dict(ops),
+        'mongo_ops_per_player': sum(ops.values()) / count if count else 0.0,
+        'kafka_messages': producer.messages,
+        'kafka_bytes': producer.bytes,
+        'kafka_bytes_per_player': producer.bytes / count if count else 0.0,
+        'alloc_bytes_per_player': allocated_per_player(pairs),
+    }
+
+
+def write_corpus(rows, output: str) -> int:
+    count = 0
+    with open(output, 'wb') as file:
+        for row in rows:
+            file.write(orjson.dumps(row) + b'\n')
+            count += 1
+    return count
+
+
+async def write_recorded_corpus(args) -> int:
+    count = 0
+    with open(args.output, 'wb') as file:
+        async for row in record(args.players, args.interval, args.match):
+            file.write(orjson.dumps(row) + b'\n')
+            count += 1
+    return count
+
+
+def parse_mixes(value: str) -> dict:
+    mixes = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name not in MIXES:
+            raise argparse.ArgumentTypeError(f'unknown mix {name!r}')
+        mixes[name] = float(weight or 1)
+    return mixes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    gen = commands.add_parser('generate', help='build a synthetic corpus')
+    gen.add_argument('--players', type=int, default=20_000)
+    gen.add_argument('--seed', type=int, default=1)
+    gen.add_argument(
+        '--mix',
+        type=parse_mixes,
+        default=MIXES,
+        help='weights, e.g. donations=0.5,legends=0.5',
+    )
+    gen.add_argument('--output', required=True)
+
+    rec = commands.add_parser('record', help='record a corpus from Redis')
+    rec.add_argument('--players', type=int, default=20_000)
+    rec.add_argument('--interval', type=int, default=120)
+    rec.add_argument('--match', default='#*')
+    rec.add_argument('--output', required=True)
+
+    run = commands.add_parser('run', help='replay a corpus')
+    run.add_argument('--corpus', required=True)
+    run.add_argument('--repeat', type=int, default=3)
+    run.add_argument('--output')
+    run.add_argument('--compare', help='results file from an earlier run')
+
+    args = parser.parse_args()
+    if args.command == 'generate':
+        count = write_corpus(
+            generate(args.players, args.seed, args.mix), args.output
+        )
+        print(f'wrote {count} pairs to {args.output}')
+    elif args.command == 'record':
+        count = asyncio.run(write_recorded_corpus(args))
+        print(f'wrote {count} changed pairs to {args.output}')
+    else:
+        pairs = load_corpus(args.corpus)
+        by_mix = defaultdict(list)
+        for pair in pairs:
+            by_mix[pair.get('mix', 'unknown')].append(pair)
+
+        start = time.perf_counter()
+        results = {'overall': measure(pairs, args.repeat)}
+        results['by_mix'] = {
+            mix: measure(mix_pairs, args.repeat)
+            for mix, mix_pairs in sorted(by_mix.items())
+        }
+        print(f'benchmark took {time.perf_counter() - start:.1f}s')
+
+        document = write_results(
+            'player_diff',
+            params={
+                'corpus': args.corpus,
+                'pairs': len(pairs),
+                'repeat': args.repeat,
+            },
+            results=results,
+            output=args.output,
+        )
+        if args.compare:
+            compare_results(args.compare, document)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Clan tracker loop time with tracing off, sampled, fully on, and the old
+per-item Sentry context and breadcrumbs.
+
+Replays synthetic clan polls (see `benchmarks.clan_events`) through
+`ClanTracker._process_clan` the way a worker runs an item: inside
+`tracer.item()` with a `diff` span, `emit` spans from `_send_to_kafka`, and
+one `finish_loop` per poll. `legacy` adds the `set_context` per item and
+the `add_breadcrumb` per item and per message the tracker used to do.
+Sentry is initialized without a DSN so nothing leaves the process.
+
+    python -m benchmarks.tracing_overhead --clans 20000
+"""
+import argparse
+import random
+import time
+
+import orjson
+import sentry_sdk
+
+from benchmarks.clan_events import make_clan, make_tracker, poll
+from benchmarks.common import write_results
+from utility.tracing import Tracer
+
+
+def run_loop(tracker, responses, legacy: bool) -> float:
+    start = time.perf_counter()
+    for i, raw_clan in enumerate(responses):
+        clan_tag = f'#C{i}'
+        with tracker.tracer.item():
+            if legacy:
+                sentry_sdk.set_context('clan_tracking', {'clan_tag': clan_tag})
+                sentry_sdk.add_breadcrumb(
+                    message=f'Tracking clan: {clan_tag}', level='info'
+                )
+            with tracker.tracer.span('diff'):
+                tracker._process_clan(clan_tag, raw_clan)
+            if legacy:
+                for _ in range(tracker.kafka.messages - tracker.sent):
+                    sentry_sdk.add_breadcrumb(
+                        message=f'Sending data to Kafka: topic=clan, key={clan_tag}',
+                        data={'data_preview': 'Data suppressed in production'},
+                        level='info',
+                    )
+                tracker.sent = tracker.kafka.messages
+    tracker.tracer.finish_loop('benchmark')
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--clans', type=int, default=20_000)
+    parser.add_argument('--polls', type=int, default=5)
+    parser.add_argument('--active', type=float, default=0.6)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    sentry_sdk.init(dsn=None, traces_sample_rate=1.0)
+
+    rng = random.Random(args.seed)
+    clans = [make_clan(rng) for _ in range(args.clans)]
+    polls = [[orjson.dumps(clan) for clan in clans]]
+    for _ in range(args.polls):
+        clans = [poll(rng, clan, args.active) for clan in clans]
+        polls.append([orjson.dumps(clan) for clan in clans])
+
+    results = {}
+    for name, tracer, legacy in (
+        ('off', Tracer(enabled=False), False),
+        ('sampled_1pct', Tracer(sample_rate=0.01), False),
+        ('sampled_all', Tracer(sample_rate=1.0), False),
+        ('legacy', Tracer(enabled=False), True),
+    ):
+        random.seed(args.seed)
+        tracker = make_tracker(coalesce=True, snapshots=False, tracer=tracer)
+        tracker.sent = 0
+        # the first poll only fills the cache
+        run_loop(tracker, polls[0], legacy)
+        loops = [run_loop(tracker, responses, legacy) for responses in polls[1:]]
+        results[name] = {
+            'best_loop_seconds': min(loops),
+            'mean_loop_seconds': sum(loops) / len(loops),
+        }
+    for name in ('sampled_1pct', 'sampled_all', 'legacy'):
+        results[name]['overhead_vs_off'] = (
+            results[name]['best_loop_seconds']
+            / results['off']['best_loop_seconds']
+            - 1
+        )
+
+    write_results(
+        'tracing_overhead',
+        params={
+            'clans': args.clans,
+            'polls': args.polls,
+            'active': args.active,
+            'seed': args.seed,
+        },
+        results=results,
+        output=args.output,
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""
+Decode throughput of /currentwar responses in the global war tracker, per core.
+
+`full` is the old decode, which builds both member lists for every
+response. `header` is the tracker's decode now: state, times and clan tags,
+with the member lists kept raw, plus the member tags for the share of wars
+that are new. Responses are synthetic 5v5 to 50v50 wars mixed with
+notInWar bodies shaped like the API's (both sides present, no tags), or a
+recorded corpus with one response body per line.
+
+    python -m benchmarks.war_decode --responses 20000 --not-in-war 0.5 --new 0.05
+"""
+import argparse
+import random
+from typing import List
+
+import orjson
+from msgspec import Struct
+from msgspec.json import Decoder
+
+from benchmarks.common import best_of, write_results
+from benchmarks.war_diff import add_attacks, make_war
+from gamewide.war.classes import war_decoder
+
+
+class LegacyMembers(Struct):
+    tag: str
+
+
+class LegacyClan(Struct):
+    tag: str
+    members: List[LegacyMembers]
+
+
+class LegacyWar(Struct):
+    state: str
+    preparationStartTime: str
+    endTime: str
+    clan: LegacyClan
+    opponent: LegacyClan
+
+
+legacy_decoder = Decoder(LegacyWar)
+
+# what /currentwar returns for a clan that isn't in a war: both sides are
+# present, without tags or members
+_EMPTY_SIDE = {
+    'badgeUrls': {
+        'small': 'https://api-assets.clashofclans.com/badges/70/example.png',
+        'large': 'https://api-assets.clashofclans.com/badges/512/example.png',
+        'medium': 'https://api-assets.clashofclans.com/badges/200/example.png',
+    },
+    'clanLevel': 0,
+    'attacks': 0,
+    'stars': 0,
+    'destructionPercentage': 0.0,
+}
+NOT_IN_WAR = {'state': 'notInWar', 'clan': _EMPTY_SIDE, 'opponent': _EMPTY_SIDE}
+
+
+def full_decode(responses: list[bytes], new: list[bool]):
+    decode = legacy_decoder.decode
+    for body, _ in zip(responses, new):
+        try:
+            war = decode(body)
+        except Exception:
+            continue
+        [m.tag for m in war.clan.members + war.opponent.members]
+
+
+def header_decode(responses: list[bytes], new: list[bool]):
+    decode = war_decoder.decode
+    for body, is_new in zip(responses, new):
+        war = decode(body)
+        if war.state == 'notInWar' or war.clan is None or war.clan.tag is None:
+            continue
+        if is_new:
+            war.clan.member_tags() + war.opponent.member_tags()
+
+
+def synthetic(rng: random.Random, count: int, not_in_war: float) -> list[bytes]:
+    responses = []
+    for _ in range(count):
+        if rng.random() < not_in_war:
+            responses.append(orjson.dumps(NOT_IN_WAR))
+            continue
+        war = make_war(rng, size=rng.choice([5, 10, 15, 20, 25, 30, 40, 50]))
+        add_attacks(rng, war, rng.randrange(war['teamSize']))
+        responses.append(orjson.dumps(war))
+    return responses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--responses', type=int, default=20_000)
+    parser.add_argument('--corpus', help='recorded responses, one body per line')
+    parser.add_argument('--not-in-war', type=float, default=0.5)
+    parser.add_argument('--new', type=float, default=0.05)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.corpus:
+        with open(args.corpus, 'rb') as file:
+            responses = [line.rstrip(b'\n') for line in file if line.strip()]
+    else:
+        responses = synthetic(rng, args.responses, args.not_in_war)
+    new = [rng.random() < args.new for _ in responses]
+    mib = sum(len(r) for r in responses) / 2**20
+
+    results = {}
+    for name, func in (('full', full_decode), ('header', header_decode)):
+        seconds, _ = best_of(args.repeat, lambda: func(responses, new))
+        results[name] = {
+            'wars_per_sec': len(responses) / seconds,
+            'mib_per_sec': mib / seconds,
+        }
+    results['speedup'] = (
+        results['header']['wars_per_sec'] / results['full']['wars_per_sec']
+    )
+
+    write_results(
+        'war_decode',
+        params={
+            'responses': len(responses),
+            'corpus': args.corpus,
+            'not_in_war': args.not_in_war,
+            'new': args.new,
+            'seed': args.seed,
+        },
+        results=results,
+        output=args.output,
+    )
+
+
+if __name__ == '__main__':
+    main()
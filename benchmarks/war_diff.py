@@ -0,0 +1,209 @@
+"""
+War diff cost per poll on synthetic 50v50 wars.
+
+Builds pairs of consecutive polls of the same war at a given number of
+attacks already made, then times the old attack and CWL lineup diffs in
+`clan_war_track` against the order based and set based helpers.
+
+    python -m benchmarks.war_diff --attacks 20 60 100 --new 2
+"""
+import argparse
+import copy
+import random
+
+import coc
+import pendulum as pend
+
+from benchmarks.common import best_of, write_results
+from benchmarks.player_diff import _tag
+from bot.war.utils import attacks_after, last_attack_order, lineup_changes
+
+CLIENT = coc.Client(raw_attribute=True)
+
+
+def _time(dt) -> str:
+    return dt.format('YYYYMMDDTHHmmss') + '.000Z'
+
+
+def make_side(rng: random.Random, size: int) -> dict:
+    return {
+        'tag': _tag(rng),
+        'name': f'clan{rng.randrange(10**6)}',
+        'clanLevel': rng.randint(1, 30),
+        'attacks': 0,
+        'stars': 0,
+        'destructionPercentage': 0.0,
+        'badgeUrls': {
+            'small': 'https://api-assets.clashofclans.com/badges/70/example.png'
+        },
+        'members': [
+            {
+                'tag': _tag(rng),
+                'name': f'player{rng.randrange(10**6)}',
+                'townhallLevel': rng.randint(10, 17),
+                'mapPosition': position,
+                'opponentAttacks': 0,
+            }
+            for position in range(1, size + 1)
+        ],
+    }
+
+
+def make_war(rng: random.Random, size: int = 50) -> dict:
+    prep = pend.now(tz=pend.UTC).subtract(hours=30)
+    return {
+        'state': 'inWar',
+        'teamSize': size,
+        'attacksPerMember': 2,
+        'preparationStartTime': _time(prep),
+        'startTime': _time(prep.add(hours=23)),
+        'endTime': _time(prep.add(hours=47)),
+        'clan': make_side(rng, size),
+        'opponent': make_side(rng, size),
+    }
+
+
+def add_attacks(rng: random.Random, war: dict, count: int):
+    """Append `count` attacks with the next orders, alternating sides."""
+    order = sum(
+        len(m.get('attacks', []))
+        for side in ('clan', 'opponent')
+        for m in war[side]['members']
+    )
+    for _ in range(count):
+        order += 1
+        side, other = (
+            ('clan', 'opponent') if order % 2 else ('opponent', 'clan')
+        )
+        attackers = [
+            m for m in war[side]['members'] if len(m.get('attacks', [])) < 2
+        ]
+        attacker = rng.choice(attackers)
+        defender = rng.choice(war[other]['members'])
+        attacker.setdefault('attacks', []).append(
+            {
+                'attackerTag': attacker['tag'],
+                'defenderTag': defender['tag'],
+                'stars': rng.randint(0, 3),
+                'destructionPercentage': rng.randint(0, 100),
+                'order': order,
+                'duration': rng.randint(30, 180),
+            }
+        )
+
+
+def make_pair(rng: random.Random, attacks: int, new: int):
+    raw = make_war(rng)
+    add_attacks(rng, raw, attacks)
+    previous = coc.ClanWar(data=copy.deepcopy(raw), client=CLIENT)
+    add_attacks(rng, raw, new)
+    # a CWL prep lineup swap on each side
+    for side in ('clan', 'opponent'):
+        raw[side]['members'][-1] = dict(
+            raw[side]['members'][-1], tag=_tag(rng)
+        )
+    current = coc.ClanWar(data=raw, client=CLIENT)
+    return previous, current
+
+
+def legacy_diff(war, previous_war):
+    clan_added = [
+        n._raw_data
+        for n in war.clan.members
+        if n.tag not in set(n.tag for n in previous_war.clan.members)
+    ]
+    clan_removed = [
+        n._raw_data
+        for n in previous_war.clan.members
+        if n.tag not in set(n.tag for n in war.clan.members)
+    ]
+    opponent_added = [
+        n._raw_data
+        for n in war.opponent.members
+        if n.tag not in set(n.tag for n in previous_war.opponent.members)
+    ]
+    opponent_removed = [
+        n._raw_data
+        for n in previous_war.opponent.members
+        if n.tag not in set(n.tag for n in war.opponent.members)
+    ]
+    if previous_war.attacks:
+        new_attacks = [
+            a for a in war.attacks if a not in set(previous_war.attacks)
+        ]
+    else:
+        new_attacks = war.attacks
+    return (
+        clan_added,
+        clan_removed,
+        opponent_added,
+        opponent_removed,
+        new_attacks,
+    )
+
+
+def order_diff(war, previous_war):
+    clan_added, clan_removed = lineup_changes(
+        war._raw_data['clan']['members'],
+        previous_war._raw_data['clan']['members'],
+    )
+    opponent_added, opponent_removed = lineup_changes(
+        war._raw_data['opponent']['members'],
+        previous_war._raw_data['opponent']['members'],
+    )
+    new_attacks = attacks_after(war, last_attack_order(previous_war))
+    return (
+        clan_added,
+        clan_removed,
+        opponent_added,
+        opponent_removed,
+        new_attacks,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--attacks', type=int, nargs='+', default=[0, 20, 60, 100]
+    )
+    parser.add_argument('--new', type=int, default=2)
+    parser.add_argument('--wars', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    results = {}
+    for attacks in args.attacks:
+        rng = random.Random(args.seed)
+        new = min(args.new, 200 - attacks)
+        pairs = [make_pair(rng, attacks, new) for _ in range(args.wars)]
+
+        for previous, current in pairs:
+            legacy, fast = legacy_diff(current, previous), order_diff(
+                current, previous
+            )
+            assert [len(x) for x in legacy] == [len(x) for x in fast]
+
+        row = {}
+        for name, diff in (('legacy', legacy_diff), ('order', order_diff)):
+            seconds, _ = best_of(
+                args.repeat,
+                lambda: [diff(current, previous) for previous, current in pairs],
+            )
+            row[name] = {'diffs_per_sec': len(pairs) / seconds}
+        row['speedup'] = (
+            row['order']['diffs_per_sec'] / row['legacy']['diffs_per_sec']
+        )
+        results[f'{attacks}_attacks'] = row
+
+    write_results(
+        'war_diff',
+        params={'new': args.new, 'wars': args.wars, 'seed': args.seed},
+        results=results,
+        output=args.output,
+    )
+
+
+if __name__ == '__main__':
+    main()
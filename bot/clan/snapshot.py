@@ -0,0 +1,121 @@
+import sys
+from typing import Tuple
+
+import numpy as np
+import orjson
+import snappy
+from msgspec import Struct
+
+# attribute name sent in `types` -> key in the /clans response
+ATTRIBUTES = {
+    'level': 'clanLevel',
+    'type': 'type',
+    'description': 'description',
+    'location': 'location',
+    'capital_league': 'capitalLeague',
+    'required_townhall': 'requiredTownhallLevel',
+    'required_trophies': 'requiredTrophies',
+    'war_win_streak': 'warWinStreak',
+    'war_league': 'warLeague',
+    'member_count': 'members',
+}
+
+
+def _hash_value(value) -> int:
+    if isinstance(value, (dict, list)):
+        return hash(orjson.dumps(value, option=orjson.OPT_SORT_KEYS))
+    return hash(value)
+
+
+class ClanSnapshot(Struct, gc=False):
+    """
+    What the clan tracker keeps between polls for one clan.
+
+    Attributes are kept as hashes, members as a tag tuple with parallel
+    donation/received arrays, and the response itself only as snappy'd
+    bytes, decoded again when an event needs the previous clan payload.
+    """
+
+    raw_hash: int
+    attributes: Tuple[int, ...]
+    member_tags: Tuple[str, ...]
+    donations: np.ndarray
+    received: np.ndarray
+    public_war_log: bool
+    raw: bytes
+
+    @classmethod
+    def build(cls, raw_hash: int, raw_clan: bytes, clan: dict) -> 'ClanSnapshot':
+        members = clan.get('memberList', [])
+        return cls(
+            raw_hash=raw_hash,
+            attributes=tuple(
+                _hash_value(clan.get(key)) for key in ATTRIBUTES.values()
+            ),
+            member_tags=tuple(m['tag'] for m in members),
+            donations=np.fromiter(
+                (m.get('donations', 0) for m in members),
+                dtype=np.int32,
+                count=len(members),
+            ),
+            received=np.fromiter(
+                (m.get('donationsReceived', 0) for m in members),
+                dtype=np.int32,
+                count=len(members),
+            ),
+            public_war_log=clan.get('isWarLogPublic', False),
+            raw=snappy.compress(raw_clan),
+        )
+
+    def clan(self) -> dict:
+        """The full clan response this snapshot was built from."""
+        return orjson.loads(snappy.decompress(self.raw))
+
+    def changed_attributes(self, previous: 'ClanSnapshot') -> list[str]:
+        return [
+            name
+            for name, new, old in zip(
+                ATTRIBUTES, self.attributes, previous.attributes
+            )
+            if new != old
+        ]
+
+    def members_joined_left(
+        self, previous: 'ClanSnapshot'
+    ) -> Tuple[set[str], set[str]]:
+        current, before = set(self.member_tags), set(previous.member_tags)
+        return current - before, before - current
+
+    def donation_deltas(self, previous: 'ClanSnapshot') -> list[dict]:
+        """Donation and received increases of members still in the clan."""
+        index = {tag: i for i, tag in enumerate(previous.member_tags)}
+        pairs = [
+            (i, index[tag])
+            for i, tag in enumerate(self.member_tags)
+            if tag in index
+        ]
+        if not pairs:
+            return []
+        now, before = np.asarray(pairs).T
+        donated = self.donations[now] - previous.donations[before]
+        received = self.received[now] - previous.received[before]
+        return [
+            {
+                'tag': self.member_tags[now[i]],
+                'donations': int(donated[i]),
+                'received': int(received[i]),
+            }
+            for i in np.flatnonzero((donated > 0) | (received > 0))
+        ]
+
+    def size(self) -> int:
+        """Approximate bytes held by this snapshot."""
+        return (
+            sys.getsizeof(self)
+            + sys.getsizeof(self.attributes)
+            + sys.getsizeof(self.member_tags)
+            + sum(sys.getsizeof(tag) for tag in self.member_tags)
+            + self.donations.nbytes
+            + self.received.nbytes
+            + sys.getsizeof(self.raw)
+        )
@@ -1,11 +1,13 @@
 import asyncio
 
+import orjson
 import pendulum as pend
-import sentry_sdk
 
 from tracking import Tracking
 from utility.config import TrackingType
 
+from .snapshot import ClanSnapshot
+
 
 class ClanTracker(Tracking):
     """Class to manage clan tracking."""
@@ -16,121 +18,213 @@ class ClanTracker(Tracking):
             max_concurrent_requests=max_concurrent_requests,
             tracker_type=tracker_type,
         )
-        self.clan_cache = {}  # Cache for tracking clan states
+        self.clan_cache: dict[str, ClanSnapshot] = {}
         self.last_private_warlog_warn = (
             {}
         )  # Cache for private war log warnings
+        # one `clan_changes` message per changed clan instead of one per type,
+        # full snapshots only if a consumer still needs them
+        self.coalesce_events = self.config.clan_coalesced_events
+        self.event_snapshots = self.config.clan_event_snapshots
+
+    async def track(self, items):
+        """Track the given clans, dropping cached state for clans no longer tracked."""
+        tracked = set(items)
+        for tag in [tag for tag in self.clan_cache if tag not in tracked]:
+            del self.clan_cache[tag]
+        for tag in [
+            tag for tag in self.last_private_warlog_warn if tag not in tracked
+        ]:
+            del self.last_private_warlog_warn[tag]
+
+        await super().track(items)
+
+        if self.clan_cache:
+            cache_bytes = sum(s.size() for s in self.clan_cache.values())
+            self.logger.info(
+                f'Clan cache: {len(self.clan_cache)} clans, '
+                f'{cache_bytes / 2**20:.1f} MiB '
+                f'({cache_bytes / len(self.clan_cache):.0f} bytes/clan).'
+            )
 
     async def _track_item(self, clan_tag):
         """Track updates for a specific clan."""
-        sentry_sdk.set_context('clan_tracking', {'clan_tag': clan_tag})
         try:
             async with self.semaphore:
-                clan = await self.coc_client.get_clan(tag=clan_tag)
+                with self.tracer.span('fetch'):
+                    raw_clan, _ = await self.fetch(
+                        url=f"https://api.clashofclans.com/v1/clans/{clan_tag.replace('#', '%23')}",
+                        tag=clan_tag,
+                    )
         except Exception as e:
             self._handle_exception(f'Error fetching clan {clan_tag}', e)
             return
 
-        previous_clan = self.clan_cache.get(clan.tag)
-        self.clan_cache[clan.tag] = clan
+        if raw_clan is None:
+            return
+
+        with self.tracer.span('diff'):
+            self._process_clan(clan_tag, raw_clan)
+
+    def _process_clan(self, clan_tag, raw_clan: bytes):
+        """Diff a fetched clan response against its cached snapshot."""
+        # most clans don't change between polls, compare the raw bytes first
+        # and only decode the clan when something actually changed
+        clan_hash = hash(raw_clan)
+        previous = self.clan_cache.get(clan_tag)
+        if previous is not None and clan_hash == previous.raw_hash:
+            if self.coalesce_events:
+                self._send_coalesced_event(clan_tag, previous)
+            else:
+                self._handle_private_warlog(clan_tag, previous)
+            return
+
+        clan = orjson.loads(raw_clan)
+        snapshot = ClanSnapshot.build(clan_hash, raw_clan, clan)
+        self.clan_cache[clan_tag] = snapshot
 
-        if previous_clan is None:
+        if previous is None:
             return
 
-        sentry_sdk.add_breadcrumb(
-            message=f'Tracking clan: {clan_tag}', level='info'
+        previous_clan = previous.clan()
+        if self.coalesce_events:
+            self._send_coalesced_event(
+                clan_tag, snapshot, previous, clan, previous_clan
+            )
+            return
+
+        self._handle_private_warlog(clan_tag, snapshot, clan)
+        self._handle_attribute_changes(
+            clan_tag, snapshot, previous, clan, previous_clan
+        )
+        self._handle_member_changes(
+            clan_tag, snapshot, previous, clan, previous_clan
+        )
+        self._handle_donation_updates(
+            clan_tag, snapshot, previous, clan, previous_clan
         )
-        self._handle_private_warlog(clan)
-        self._handle_attribute_changes(clan, previous_clan)
-        self._handle_member_changes(clan, previous_clan)
-        self._handle_donation_updates(clan, previous_clan)
 
-    def _handle_private_warlog(self, clan):
-        """Handle cases where the war log is private."""
+    def _private_warlog_due(self, clan_tag, snapshot) -> bool:
+        """True if the clan's war log is private and it wasn't warned about in 12h."""
+        if snapshot.public_war_log:
+            return False
         now = pend.now(tz=pend.UTC)
-        last_warn = self.last_private_warlog_warn.get(clan.tag)
-
-        if not clan.public_war_log:
-            if (
-                last_warn is None
-                or (now - last_warn).total_seconds() >= 12 * 3600
-            ):
-                self.last_private_warlog_warn[clan.tag] = now
-                json_data = {'type': 'war_log_closed', 'clan': clan._raw_data}
-                self._send_to_kafka('clan', clan.tag, json_data)
-
-    def _handle_attribute_changes(self, clan, previous_clan):
+        last_warn = self.last_private_warlog_warn.get(clan_tag)
+        if last_warn is None or (now - last_warn).total_seconds() >= 12 * 3600:
+            self.last_private_warlog_warn[clan_tag] = now
+            return True
+        return False
+
+    def _handle_private_warlog(self, clan_tag, snapshot, clan=None):
+        """Handle cases where the war log is private."""
+        if self._private_warlog_due(clan_tag, snapshot):
+            json_data = {
+                'type': 'war_log_closed',
+                'clan': clan if clan is not None else snapshot.clan(),
+            }
+            self._send_to_kafka('clan', clan_tag, json_data)
+
+    def _handle_attribute_changes(
+        self, clan_tag, snapshot, previous, clan, previous_clan
+    ):
         """Handle changes in clan attributes."""
-        attributes = [
-            'level',
-            'type',
-            'description',
-            'location',
-            'capital_league',
-            'required_townhall',
-            'required_trophies',
-            'war_win_streak',
-            'war_league',
-            'member_count',
-        ]
-        changed_attributes = [
-            attr
-            for attr in attributes
-            if getattr(clan, attr) != getattr(previous_clan, attr)
-        ]
+        changed_attributes = snapshot.changed_attributes(previous)
 
         if changed_attributes:
             json_data = {
                 'types': changed_attributes,
-                'old_clan': previous_clan._raw_data,
-                'new_clan': clan._raw_data,
+                'old_clan': previous_clan,
+                'new_clan': clan,
             }
-            self._send_to_kafka('clan', clan.tag, json_data)
+            self._send_to_kafka('clan', clan_tag, json_data)
 
-    def _handle_member_changes(self, clan, previous_clan):
+    def _handle_member_changes(
+        self, clan_tag, snapshot, previous, clan, previous_clan
+    ):
         """Handle changes in clan membership."""
-        current_members = clan.members_dict
-        previous_members = previous_clan.members_dict
-
-        members_joined = [
-            n._raw_data for n in clan.members if n.tag not in previous_members
-        ]
-        members_left = [
-            m._raw_data
-            for m in previous_clan.members
-            if m.tag not in current_members
-        ]
-
-        if members_joined or members_left:
+        joined, left = snapshot.members_joined_left(previous)
+
+        if joined or left:
             json_data = {
                 'type': 'members_join_leave',
-                'old_clan': previous_clan._raw_data,
-                'new_clan': clan._raw_data,
-                'joined': members_joined,
-                'left': members_left,
+                'old_clan': previous_clan,
+                'new_clan': clan,
+                'joined': [
+                    m for m in clan.get('memberList', []) if m['tag'] in joined
+                ],
+                'left': [
+                    m
+                    for m in previous_clan.get('memberList', [])
+                    if m['tag'] in left
+                ],
             }
-            self._send_to_kafka('clan', clan.tag, json_data)
+            self._send_to_kafka('clan', clan_tag, json_data)
 
-    def _handle_donation_updates(self, clan, previous_clan):
+    def _handle_donation_updates(
+        self, clan_tag, snapshot, previous, clan, previous_clan
+    ):
         """Handle updates to member donations."""
-        previous_donations = {
-            n.tag: (n.donations, n.received) for n in previous_clan.members
-        }
+        if snapshot.donation_deltas(previous):
+            json_data = {
+                'type': 'all_member_donations',
+                'old_clan': previous_clan,
+                'new_clan': clan,
+            }
+            self._send_to_kafka('clan', clan_tag, json_data)
+
+    def _send_coalesced_event(
+        self, clan_tag, snapshot, previous=None, clan=None, previous_clan=None
+    ):
+        """
+        Send every change of one poll as a single `clan_changes` message.
+
+        `types` holds the legacy event types that apply (attribute names,
+        `members_join_leave`, `all_member_donations`, `war_log_closed`),
+        `joined`/`left` the member payloads and `donations` the per-member
+        increases. `old_clan`/`new_clan` are only attached when
+        `event_snapshots` is on, except that `war_log_closed` always carries
+        the clan.
+        """
+        types = []
+        if self._private_warlog_due(clan_tag, snapshot):
+            types.append('war_log_closed')
+
+        joined, left, donations = set(), set(), []
+        if previous is not None:
+            types.extend(snapshot.changed_attributes(previous))
+            joined, left = snapshot.members_joined_left(previous)
+            if joined or left:
+                types.append('members_join_leave')
+            donations = snapshot.donation_deltas(previous)
+            if donations:
+                types.append('all_member_donations')
+
+        if not types:
+            return
 
-        for member in clan.members:
-            if (donated := previous_donations.get(member.tag)) is not None:
-                mem_donos, mem_received = donated
-                if (
-                    mem_donos < member.donations
-                    or mem_received < member.received
-                ):
-                    json_data = {
-                        'type': 'all_member_donations',
-                        'old_clan': previous_clan._raw_data,
-                        'new_clan': clan._raw_data,
-                    }
-                    self._send_to_kafka('clan', clan.tag, json_data)
-                    break
+        json_data = {
+            'type': 'clan_changes',
+            'types': types,
+            'tag': clan_tag,
+            'joined': [
+                m for m in clan.get('memberList', []) if m['tag'] in joined
+            ]
+            if joined
+            else [],
+            'left': [
+                m
+                for m in previous_clan.get('memberList', [])
+                if m['tag'] in left
+            ]
+            if left
+            else [],
+            'donations': donations,
+        }
+        if self.event_snapshots or 'war_log_closed' in types:
+            json_data['new_clan'] = clan if clan is not None else snapshot.clan()
+        if self.event_snapshots and previous_clan is not None:
+            json_data['old_clan'] = previous_clan
+        self._send_to_kafka('clan', clan_tag, json_data)
 
 
 if __name__ == '__main__':
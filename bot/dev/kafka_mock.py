@@ -4,13 +4,35 @@ class MockKafkaProducer:
     def __init__(self):
         self.messages = []  # Store all messages sent
 
-    def send(self, topic, value, key, timestamp_ms):
+    @property
+    def queue_depth(self) -> int:
+        return 0
+
+    async def start(self):
+        pass
+
+    def send(self, topic, value=None, key=None, timestamp_ms=None):
         self.messages.append(
             {
                 'topic': topic,
-                'key': key.decode('utf-8'),
+                'key': key.decode('utf-8') if key is not None else None,
                 # "value": value.decode("utf-8")
                 'timestamp_ms': timestamp_ms,
             }
         )
         print(f'[MOCK PRODUCER] Message sent: {self.messages[-1]}')
+
+    async def backpressure(self):
+        pass
+
+    async def flush(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def stats(self) -> dict:
+        return {'queue_depth': 0, 'failed': 0, 'topics': {}}
+
+    def log_stats(self):
+        pass
@@ -0,0 +1,235 @@
+from typing import Iterable, Optional
+
+import numpy as np
+import pendulum as pend
+import snappy
+from msgspec import msgpack
+
+# legend league allows this many attacks and defenses per legend day
+DAILY_ATTACKS = 8
+DAILY_DEFENSES = 8
+
+COLUMNS = {
+    'trophies': np.int32,
+    'attack_wins': np.int32,
+    'defense_wins': np.int32,
+    'attacks_today': np.int16,
+    'defenses_today': np.int16,
+    'last_active': np.int64,
+}
+
+
+class LegendBaseline:
+    """
+    Previous poll values for every tracked legend player, stored column-wise.
+
+    Each tag owns a slot in parallel `trophies`, `attack_wins` and
+    `defense_wins` arrays. A fetched batch is compared in one vectorized pass
+    and only the players whose trophies moved are handed back, so the Python
+    level work per loop scales with the number of changes.
+
+    Alongside the compared values it keeps the attacks and defenses used on
+    the current legend day and the last time each player's trophies moved,
+    which `due` uses to poll exhausted and dormant players less often.
+    """
+
+    def __init__(self, capacity: int = 1024, legend_date: str = None):
+        self.slots: dict[str, int] = {}
+        self.free: list[int] = []
+        self.used: int = 0
+        self.legend_date: Optional[str] = legend_date
+        for name, dtype in COLUMNS.items():
+            setattr(self, name, np.zeros(capacity, dtype=dtype))
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+    def __contains__(self, tag: str) -> bool:
+        return tag in self.slots
+
+    @property
+    def capacity(self) -> int:
+        return len(self.trophies)
+
+    def _grow(self, needed: int):
+        capacity = self.capacity
+        while capacity < needed:
+            capacity *= 2
+        for name in COLUMNS:
+            column = getattr(self, name)
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[: len(column)] = column
+            setattr(self, name, grown)
+
+    def _assign(self, tags: list[str]) -> np.ndarray:
+        """Give every tag in `tags` a slot, reusing freed ones first."""
+        reused = min(len(self.free), len(tags))
+        slots = [self.free.pop() for _ in range(reused)]
+        slots.extend(range(self.used, self.used + len(tags) - reused))
+        self.used += len(tags) - reused
+        if self.used > self.capacity:
+            self._grow(self.used)
+        self.slots.update(zip(tags, slots))
+        return np.asarray(slots, dtype=np.int64)
+
+    def _lookup(self, tags: list[str]) -> np.ndarray:
+        get = self.slots.get
+        return np.fromiter(
+            (get(tag, -1) for tag in tags), dtype=np.int64, count=len(tags)
+        )
+
+    def start_day(self, legend_date: str):
+        """Reset the daily attack/defense counters when the legend day rolls over."""
+        if legend_date != self.legend_date:
+            self.legend_date = legend_date
+            self.attacks_today[:] = 0
+            self.defenses_today[:] = 0
+
+    def compare(
+        self,
+        tags: list[str],
+        trophies: np.ndarray,
+        attack_wins: np.ndarray,
+        defense_wins: np.ndarray,
+    ):
+        """
+        Compare a batch against the baseline and update it.
+
+        Players seen for the first time are stored as the baseline. Players
+        whose trophies changed get their new values stored and are returned,
+        together with their previous values:
+        `(batch_indexes, prev_trophies, prev_attack_wins, prev_defense_wins)`.
+        Players whose trophies did not change keep their old baseline, so
+        defense wins that came without a trophy change are picked up with the
+        next trophy change.
+        """
+        now = int(pend.now(tz=pend.UTC).timestamp())
+        slots = self._lookup(tags)
+        known = slots >= 0
+
+        if not known.all():
+            new = np.flatnonzero(~known)
+            slots[new] = self._assign([tags[i] for i in new])
+            self.trophies[slots[new]] = trophies[new]
+            self.attack_wins[slots[new]] = attack_wins[new]
+            self.defense_wins[slots[new]] = defense_wins[new]
+            self.attacks_today[slots[new]] = 0
+            self.defenses_today[slots[new]] = 0
+            self.last_active[slots[new]] = now
+
+        known_indexes = np.flatnonzero(known)
+        known_slots = slots[known_indexes]
+        moved = self.trophies[known_slots] != trophies[known_indexes]
+        changed = known_indexes[moved]
+        changed_slots = known_slots[moved]
+
+        previous = (
+            self.trophies[changed_slots],
+            self.attack_wins[changed_slots],
+            self.defense_wins[changed_slots],
+        )
+
+        # a trophy gain is at least one attack and a loss at least one
+        # defense; the defense wins delta counts the same defenses, so it is
+        # the larger of the two, not their sum
+        gained = trophies[changed] > previous[0]
+        self.attacks_today[changed_slots] += np.where(
+            gained, np.maximum(attack_wins[changed] - previous[1], 1), 0
+        ).astype(np.int16)
+        self.defenses_today[changed_slots] += np.maximum(
+            (~gained).astype(np.int16), defense_wins[changed] - previous[2]
+        ).astype(np.int16)
+        self.last_active[changed_slots] = now
+
+        self.trophies[changed_slots] = trophies[changed]
+        self.attack_wins[changed_slots] = attack_wins[changed]
+        self.defense_wins[changed_slots] = defense_wins[changed]
+        return (changed, *previous)
+
+    def due(
+        self,
+        tags: list[str],
+        loop_count: int,
+        exhausted_every: int,
+        dormant_every: int,
+        dormant_after: int,
+    ) -> list[str]:
+        """
+        The subset of `tags` to poll this loop.
+
+        Players who used every attack and defense today are polled every
+        `exhausted_every` loops, players whose trophies haven't moved in
+        `dormant_after` seconds every `dormant_every` loops, everyone else
+        (including players not in the baseline yet) every loop. Slots are
+        offset by their index so reduced players are spread across loops.
+        """
+        now = int(pend.now(tz=pend.UTC).timestamp())
+        slots = self._lookup(tags)
+        known = slots >= 0
+        safe_slots = np.where(known, slots, 0)
+
+        exhausted = (self.attacks_today[safe_slots] >= DAILY_ATTACKS) & (
+            self.defenses_today[safe_slots] >= DAILY_DEFENSES
+        )
+        dormant = now - self.last_active[safe_slots] >= dormant_after
+
+        due = np.ones(len(tags), dtype=bool)
+        due &= ~exhausted | ((safe_slots + loop_count) % exhausted_every == 0)
+        due &= ~dormant | ((safe_slots + loop_count) % dormant_every == 0)
+        due |= ~known
+        return [tags[i] for i in np.flatnonzero(due)]
+
+    def remove(self, tag: str):
+        slot = self.slots.pop(tag, None)
+        if slot is not None:
+            self.free.append(slot)
+
+    def retain(self, tags: Iterable[str]):
+        """Drop every tag that is not in `tags`."""
+        keep = set(tags)
+        for tag in [tag for tag in self.slots if tag not in keep]:
+            self.remove(tag)
+
+    def dump(self) -> bytes:
+        """Serialize the occupied slots into a compact snappy'd msgpack blob."""
+        tags = list(self.slots)
+        slots = np.fromiter(
+            self.slots.values(), dtype=np.int64, count=len(tags)
+        )
+        snapshot = {
+            'timestamp': int(pend.now(tz=pend.UTC).timestamp()),
+            'legend_date': self.legend_date,
+            'tags': tags,
+        }
+        for name in COLUMNS:
+            snapshot[name] = getattr(self, name)[slots].tobytes()
+        return snappy.compress(msgpack.encode(snapshot))
+
+    @classmethod
+    def load(cls, data: bytes, max_age: int) -> Optional['LegendBaseline']:
+        """
+        Rebuild a baseline from `dump` output.
+
+        Returns None if the snapshot is older than `max_age` seconds, since
+        diffs against a stale baseline would lump many polls into one change.
+        """
+        snapshot = msgpack.decode(snappy.decompress(data))
+        age = int(pend.now(tz=pend.UTC).timestamp()) - snapshot['timestamp']
+        if age > max_age:
+            return None
+
+        tags = snapshot['tags']
+        baseline = cls(
+            capacity=max(len(tags), 1024),
+            legend_date=snapshot.get('legend_date'),
+        )
+        baseline.slots = dict(zip(tags, range(len(tags))))
+        baseline.used = len(tags)
+        if 'last_active' not in snapshot:
+            baseline.last_active[: len(tags)] = snapshot['timestamp']
+        for name, dtype in COLUMNS.items():
+            if name not in snapshot:
+                continue
+            column = np.frombuffer(snapshot[name], dtype=dtype)
+            getattr(baseline, name)[: len(tags)] = column
+        return baseline
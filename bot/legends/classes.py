@@ -1,44 +1,77 @@
 from typing import List, Optional
 
+from msgspec import Raw, Struct
+from msgspec.json import Decoder, decode
 
-class Clan:
-    def __init__(self, raw_data: dict):
-        self.name: str = raw_data.get('name')
-        self.tag: str = raw_data.get('tag')
+NULL = Raw(b'null')
 
 
-class Equipment:
-    def __init__(self, raw_data: dict):
-        self.name: str = raw_data.get('name')
-        self.level: int = raw_data.get('level')
+class Clan(Struct):
+    tag: Optional[str] = None
+    name: Optional[str] = None
 
 
-class Heroes:
-    def __init__(self, raw_data: dict):
-        self.name = raw_data.get('name')
-        self.equipment: Optional[List[Equipment]] = [
-            Equipment(raw_data=data) for data in raw_data.get('equipment')
-        ]
+class Equipment(Struct):
+    name: str
+    level: int
 
 
-class League:
-    def __init__(self, raw_data: dict):
-        self.name = raw_data.get('name', 'Unranked')
+class Heroes(Struct):
+    name: str
+    equipment: List[Equipment] = []
 
 
-class Player:
-    def __init__(self, raw_data: dict) -> None:
-        self.raw_data: dict = raw_data
-        self.name = raw_data.get('name')
-        self.tag = raw_data.get('tag')
-        self.trophies: int = raw_data.get('trophies')
-        self.attackWins: int = raw_data.get('attackWins')
-        self.defenseWins: int = raw_data.get('defenseWins')
-        self.heroes: List[Heroes] = [
-            Heroes(raw_data=data) for data in raw_data.get('heroes')
-        ]
-        self.equipment: List[Equipment] = [
-            Equipment(raw_data=data) for data in raw_data.get('heroEquipment')
+class League(Struct):
+    name: str = 'Unranked'
+
+
+class Player(Struct, gc=False):
+    """
+    Legends view of a player, decoded straight from the response bytes.
+
+    Only the fields compared every poll are decoded. `clan`, `league`,
+    `heroes` and `heroEquipment` stay as raw JSON and are only decoded
+    when a trophy change is recorded. The raw slices are copied out of the
+    response buffer so a cached player does not keep the whole response alive.
+    """
+
+    tag: str
+    name: str
+    trophies: int
+    attackWins: int
+    defenseWins: int
+    clan: Raw = NULL
+    league: Raw = NULL
+    heroes: Raw = NULL
+    heroEquipment: Raw = NULL
+
+    def __post_init__(self):
+        self.clan = self.clan.copy()
+        self.league = self.league.copy()
+        self.heroes = self.heroes.copy()
+        self.heroEquipment = self.heroEquipment.copy()
+
+    @property
+    def clan_tag(self) -> Optional[str]:
+        clan = decode(self.clan, type=Optional[Clan])
+        return clan.tag if clan is not None else None
+
+    @property
+    def league_name(self) -> str:
+        league = decode(self.league, type=Optional[League])
+        return league.name if league is not None else 'Unranked'
+
+    def get_heroes(self) -> List[Heroes]:
+        return decode(self.heroes, type=Optional[List[Heroes]]) or []
+
+    def hero_gear(self) -> List[dict]:
+        """The equipment currently worn by each hero."""
+        return [
+            {'name': gear.name, 'level': gear.level}
+            for hero in self.get_heroes()
+            for gear in hero.equipment
         ]
-        self.clan: Clan = Clan(raw_data=raw_data.get('clan', {}))
-        self.league: League = League(raw_data=raw_data.get('league'))
+
+
+# reused across fetches, msgspec keeps the compiled decode plan on the decoder
+player_decoder = Decoder(Player)
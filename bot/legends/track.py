@@ -1,33 +1,67 @@
 import asyncio
 import itertools
+import time
 from collections import deque
 from typing import List
 
 import aiohttp
-import orjson
+import numpy as np
 import pendulum as pend
-from kafka import KafkaProducer
 from loguru import logger
+from msgspec.json import encode
+from msgspec.structs import replace
 from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from redis import asyncio as redis
 
 from utility.classes import MongoDatabase
 from utility.keycreation import create_keys
+from utility.producer import AsyncKafkaProducer
 from utility.utils import gen_legend_date
 
-from .classes import Player
+from .baseline import LegendBaseline
+from .classes import Player, player_decoder
 from .config import LegendTrackingConfig
 
+# write error codes worth retrying: the op wasn't applied because of a
+# failover, shutdown, timeout or conflict, not because it is invalid
+TRANSIENT_WRITE_ERRORS = {
+    6,  # HostUnreachable
+    7,  # HostNotFound
+    50,  # MaxTimeMSExpired
+    89,  # NetworkTimeout
+    91,  # ShutdownInProgress
+    112,  # WriteConflict
+    189,  # PrimarySteppedDown
+    262,  # ExceededTimeLimit
+    9001,  # SocketException
+    10107,  # NotWritablePrimary
+    11600,  # InterruptedAtShutdown
+    11602,  # InterruptedDueToReplStateChange
+    13435,  # NotPrimaryNoSecondaryOk
+}
+
 
 class Tracker:
     def __init__(self, config: LegendTrackingConfig):
-        self.cache: dict[str, Player] = {}
-        self.producer = KafkaProducer(
-            bootstrap_servers=['85.10.200.219:9092'], api_version=(3, 6, 0)
-        )
+        self.baseline = LegendBaseline()
+        self.producer = AsyncKafkaProducer()
         self.db_client = MongoDatabase(
             stats_db_connection=config.stats_mongodb,
             static_db_connection=config.static_mongodb,
         )
+        self.redis = redis.Redis(
+            host=config.redis_ip,
+            port=6379,
+            db=0,
+            password=config.redis_pw,
+            decode_responses=False,
+            max_connections=50,
+            health_check_interval=10,
+            socket_connect_timeout=5,
+            retry_on_timeout=True,
+            socket_keepalive=True,
+        )
         self.keys: deque = asyncio.get_event_loop().run_until_complete(
             create_keys(
                 [
@@ -45,19 +79,27 @@ class Tracker:
         self._running: bool = True
         self.legend_date: str = gen_legend_date()
 
-        self.fields: list = [
-            'name',
-            'tag',
-            'trophies',
-            'attackWins',
-            'defenseWins',
-            'heroes',
-            'heroEquipment',
-            'clan',
-            'league',
-        ]
+        # warm start: the baseline is snapshotted to redis so a restart
+        # doesn't lose a poll cycle of attacks & defenses
+        self.snapshot_key: str = 'legends:baseline'
+        self.snapshot_interval: int = 60
+        self.snapshot_max_age: int = 600
+
+        # players who used all 8 attacks & defenses today, or whose trophies
+        # haven't moved in a while, are polled every Nth loop instead
+        self.exhausted_poll_every: int = 10
+        self.dormant_poll_every: int = 5
+        self.dormant_after: int = 3 * 24 * 60 * 60
 
+        # write-behind: compare_players only appends, the flush loop swaps
+        # the buffer out and writes it in the background
         self.db_changes: list = []
+        self.failed_changes: deque = deque()  # (attempt, changes)
+        self.flush_size: int = 5_000
+        self.flush_interval: int = 10
+        self.max_flush_attempts: int = 5
+        self.last_flush: float = time.monotonic()
+        self.flush_latency: deque = deque(maxlen=100)
 
     async def fetch_tags_to_track(self):
         self.tracked_tags = await self.db_client.player_stats.distinct(
@@ -76,34 +118,76 @@ class Tracker:
     def stop_background_update(self):
         self._running = False
 
+    async def save_baseline(self):
+        await self.redis.set(
+            self.snapshot_key,
+            self.baseline.dump(),
+            ex=self.snapshot_max_age,
+        )
+
+    async def load_baseline(self):
+        try:
+            data = await self.redis.get(self.snapshot_key)
+            baseline = (
+                LegendBaseline.load(data, max_age=self.snapshot_max_age)
+                if data is not None
+                else None
+            )
+        except Exception as e:
+            logger.error(f'Failed to load legends baseline snapshot: {e}')
+            return
+        if baseline is None:
+            logger.info('No fresh legends baseline snapshot, starting cold')
+            return
+        self.baseline = baseline
+        logger.info(f'Warm started with {len(baseline)} legend players')
+
+    async def snapshot_loop(self):
+        while self._running:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                await self.save_baseline()
+            except Exception as e:
+                logger.error(f'Failed to snapshot legends baseline: {e}')
+
+    def start_background_snapshot(self):
+        asyncio.create_task(self.snapshot_loop())
+
     async def remove_old_tags(self):
-        tag_set = set(self.tracked_tags)
-        keys_to_remove = [key for key in self.cache if key not in tag_set]
-        for key in keys_to_remove:
-            del self.cache[key]
+        self.baseline.retain(self.tracked_tags)
+
+    def tags_to_poll(self, loop_count: int) -> list[str]:
+        # counters reset at the 5:00 UTC legend day rollover, so everyone is
+        # back to full rate polling for the new day
+        self.baseline.start_day(self.get_legend_date())
+        return self.baseline.due(
+            self.tracked_tags,
+            loop_count=loop_count,
+            exhausted_every=self.exhausted_poll_every,
+            dormant_every=self.dormant_poll_every,
+            dormant_after=self.dormant_after,
+        )
 
-    def split_tags(self) -> list[list[str]]:
+    def split_tags(self, tags: list[str]) -> list[list[str]]:
         return [
-            self.tracked_tags[i : i + self.split_size]
-            for i in range(0, len(self.tracked_tags), self.split_size)
+            tags[i : i + self.split_size]
+            for i in range(0, len(tags), self.split_size)
         ]
 
     async def fetch(
         self, url: str, session: aiohttp.ClientSession, headers: dict
-    ) -> tuple[str, str | None | dict]:
+    ) -> tuple[str, str | None | Player]:
         async with session.get(url, headers=headers) as response:
             tag = f'#{url.split("%23")[-1]}'
             if response.status == 404:  # remove banned players
                 return tag, 'delete'
             elif response.status != 200:
                 return tag, None
-            new_response = await response.read()
-            response = orjson.loads(new_response)
-            return tag, {key: response.get(key) for key in self.fields}
+            return tag, player_decoder.decode(await response.read())
 
     async def get_player_responses(
         self, tags: List[str]
-    ) -> List[tuple[str, str | None | dict]]:
+    ) -> List[tuple[str, str | None | Player]]:
         connector = aiohttp.TCPConnector(limit=1200, ttl_dns_cache=300)
         timeout = aiohttp.ClientTimeout(total=1800)
         async with aiohttp.ClientSession(
@@ -168,35 +252,68 @@ class Tracker:
             ),
         ]
 
-    def compare_players(self, player: Player):
-        previous_player: Player = self.cache.get(player.tag)
-
-        if previous_player is None:
-            self.cache[player.tag] = player
-            return
-
-        if previous_player.trophies == player.trophies:
+    def compare_players(self, players: List[Player]):
+        """Compare a fetched batch with the baseline and record the changes."""
+        count = len(players)
+        (
+            changed,
+            prev_trophies,
+            prev_attacks,
+            prev_defenses,
+        ) = self.baseline.compare(
+            tags=[player.tag for player in players],
+            trophies=np.fromiter(
+                (p.trophies for p in players), dtype=np.int32, count=count
+            ),
+            attack_wins=np.fromiter(
+                (p.attackWins for p in players), dtype=np.int32, count=count
+            ),
+            defense_wins=np.fromiter(
+                (p.defenseWins for p in players),
+                dtype=np.int32,
+                count=count,
+            ),
+        )
+        if not len(changed):
             return
 
         legend_date = self.get_legend_date()
-        self.cache[player.tag] = player
+        for index, trophies, attack_wins, defense_wins in zip(
+            changed.tolist(),
+            prev_trophies.tolist(),
+            prev_attacks.tolist(),
+            prev_defenses.tolist(),
+        ):
+            player = players[index]
+            # only the compared fields are kept between polls, the rest of the
+            # previous snapshot is taken from the current response
+            previous_player = replace(
+                player,
+                trophies=trophies,
+                attackWins=attack_wins,
+                defenseWins=defense_wins,
+            )
+            self.record_changes(player, previous_player, legend_date)
 
-        if player.trophies <= 4900 and player.league.name != 'Legend League':
+    def record_changes(
+        self, player: Player, previous_player: Player, legend_date: str
+    ):
+        if player.trophies <= 4900 and player.league_name != 'Legend League':
             return
 
         json_data = {
             'types': ['legends'],
-            'old_data': previous_player.raw_data,
-            'new_data': player.raw_data,
+            'old_data': previous_player,
+            'new_data': player,
             'timestamp': int(pend.now(tz=pend.UTC).timestamp()),
         }
 
-        if player.clan.tag in self.clan_tags:
+        clan_tag = player.clan_tag
+        if clan_tag in self.clan_tags:
             self.producer.send(
                 topic='player',
-                value=orjson.dumps(json_data),
-                key=player.clan.tag.encode('utf-8'),
-                timestamp_ms=int(pend.now(tz=pend.UTC).timestamp()) * 1000,
+                value=encode(json_data),
+                key=clan_tag.encode('utf-8'),
             )
 
         trophy_change = player.trophies - previous_player.trophies
@@ -211,11 +328,7 @@ class Tracker:
                 )
 
         elif trophy_change > 0:
-            equipment = [
-                {'name': gear.name, 'level': gear.level}
-                for hero in player.heroes
-                for gear in hero.equipment
-            ]
+            equipment = player.hero_gear()
             self.db_changes.append(
                 UpdateOne(
                     {'tag': player.tag},
@@ -270,51 +383,137 @@ class Tracker:
             for _ in range(diff_defenses):
                 self.db_changes.extend(self.create_defense_update(0, player))
 
+    @property
+    def queue_depth(self) -> int:
+        return len(self.db_changes) + sum(
+            len(changes) for _, changes in self.failed_changes
+        )
+
     async def insert_db_changes(self):
-        logger.info(f'{len(self.db_changes)} db changes')
-        if self.db_changes:
-            await self.db_client.player_stats.bulk_write(self.db_changes)
+        changes, self.db_changes = self.db_changes, []
+        self.last_flush = time.monotonic()
+
+        # retries go first, so their pushes land before newer changes
+        batches = list(self.failed_changes)
+        self.failed_changes.clear()
+        if changes:
+            batches.append((0, changes))
+
+        for attempt, batch in batches:
+            start = time.monotonic()
+            try:
+                await self.db_client.player_stats.bulk_write(
+                    batch, ordered=False
+                )
+                failed = []
+            except BulkWriteError as e:
+                # unordered, so everything but the reported errors went
+                # through; only ops that failed transiently are retried,
+                # as the $push/$inc changes aren't safe to apply twice
+                errors = e.details.get('writeErrors', [])
+                failed = [
+                    batch[error['index']]
+                    for error in errors
+                    if error.get('code') in TRANSIENT_WRITE_ERRORS
+                ]
+                if len(failed) < len(errors):
+                    logger.error(
+                        f'Dropping {len(errors) - len(failed)} legends db '
+                        f'changes with permanent write errors'
+                    )
+            except Exception as e:
+                # part of the batch may have been applied, a retry could
+                # push attacks and defenses twice
+                logger.error(
+                    f'Legends db flush failed, dropping {len(batch)} changes: {e}'
+                )
+                failed = []
+            self.flush_latency.append(time.monotonic() - start)
+
+            if failed and attempt + 1 < self.max_flush_attempts:
+                self.failed_changes.append((attempt + 1, failed))
+            elif failed:
+                logger.error(
+                    f'Dropping {len(failed)} legends db changes after '
+                    f'{self.max_flush_attempts} attempts'
+                )
+
+        if batches:
+            logger.info(
+                f'{sum(len(b) for _, b in batches)} db changes flushed | '
+                f'last flush {self.flush_latency[-1]:.2f}s | '
+                f'avg flush {sum(self.flush_latency) / len(self.flush_latency):.2f}s | '
+                f'queue depth {self.queue_depth}'
+            )
+
+    async def flush_loop(self):
+        while self._running:
+            await asyncio.sleep(1)
+            if (
+                len(self.db_changes) >= self.flush_size
+                or time.monotonic() - self.last_flush >= self.flush_interval
+            ):
+                await self.insert_db_changes()
+
+    def start_background_flush(self):
+        asyncio.create_task(self.flush_loop())
 
 
 async def main():
 
     tracker = Tracker(config=LegendTrackingConfig())
 
-    tracker.start_background_update()
+    await tracker.producer.start()
+    try:
+        await tracker.load_baseline()
+        tracker.start_background_update()
+        tracker.start_background_snapshot()
+        tracker.start_background_flush()
 
-    while not tracker.clan_tags:
-        logger.info(f'Waiting on tags to load, sleeping 5 seconds')
-        await asyncio.sleep(5)
-        continue
-
-    for loop_count in itertools.count():
-        try:
-            await tracker.remove_old_tags()
-            logger.info(f'{len(tracker.tracked_tags)} players to track')
+        while not tracker.clan_tags:
+            logger.info(f'Waiting on tags to load, sleeping 5 seconds')
+            await asyncio.sleep(5)
+            continue
 
-            for count, group in enumerate(tracker.split_tags(), 1):
-                logger.info(
-                    f'LOOP {loop_count} | Group {count}/{len(tracker.split_tags())}: {len(group)} tags'
-                )
-                current_player_responses = await tracker.get_player_responses(
-                    tags=group
-                )
+        for loop_count in itertools.count():
+            try:
+                await tracker.remove_old_tags()
+                tags = tracker.tags_to_poll(loop_count)
                 logger.info(
-                    f'LOOP {loop_count} | Group {count}: Pulled Responses'
+                    f'{len(tracker.tracked_tags)} players to track, '
+                    f'{len(tags)} due this loop'
                 )
 
-                for tag, response in current_player_responses:
-                    if response is None:
-                        continue
-
-                    if response == 'delete':
-                        await tracker.db_client.player_stats.delete_one(
-                            {'tag': tag}
-                        )
-                        tracker.cache.pop(tag, 'gone')
-                        continue
+                groups = tracker.split_tags(tags)
+                for count, group in enumerate(groups, 1):
+                    logger.info(
+                        f'LOOP {loop_count} | Group {count}/{len(groups)}: {len(group)} tags'
+                    )
+                    await tracker.producer.backpressure()
+                    current_player_responses = await tracker.get_player_responses(
+                        tags=group
+                    )
+                    logger.info(
+                        f'LOOP {loop_count} | Group {count}: Pulled Responses'
+                    )
 
-                    player = Player(raw_data=response)
-                    tracker.compare_players(player=player)
-        except:
-            continue
+                    players = []
+                    for tag, response in current_player_responses:
+                        if response is None:
+                            continue
+
+                        if response == 'delete':
+                            await tracker.db_client.player_stats.delete_one(
+                                {'tag': tag}
+                            )
+                            tracker.baseline.remove(tag)
+                            continue
+
+                        players.append(response)
+
+                    tracker.compare_players(players=players)
+                tracker.producer.log_stats()
+            except:
+                continue
+    finally:
+        await tracker.producer.stop()
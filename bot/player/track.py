@@ -4,13 +4,13 @@ from collections import defaultdict, deque
 import orjson
 import pendulum as pend
 import snappy
-from kafka import KafkaProducer
 from loguru import logger
 from pymongo import InsertOne, UpdateOne
 from redis import asyncio as redis
 
 from utility.classes import MongoDatabase
 from utility.keycreation import create_keys
+from utility.producer import AsyncKafkaProducer
 from utility.utils import gen_games_season, gen_raid_date, gen_season_date
 
 from .config import BotPlayerTrackingConfig
@@ -26,9 +26,17 @@ from .utils import (
 async def main():
     config = BotPlayerTrackingConfig()
 
-    producer = KafkaProducer(
-        bootstrap_servers=['85.10.200.219:9092'], api_version=(3, 6, 0)
-    )
+    producer = AsyncKafkaProducer()
+    await producer.start()
+    try:
+        await track(config, producer)
+    finally:
+        await producer.stop()
+
+
+async def track(
+    config: BotPlayerTrackingConfig, producer: AsyncKafkaProducer
+):
     db_client = MongoDatabase(
         stats_db_connection=config.stats_mongodb,
         static_db_connection=config.static_mongodb,
@@ -143,6 +151,7 @@ async def main():
                 )
 
                 # pull previous responses from cache + map to a dict so we can easily pull
+                await producer.backpressure()
                 previous_player_responses = await cache.mget(keys=group)
                 previous_player_responses = {
                     tag: response
@@ -538,10 +547,6 @@ async def main():
                                     topic='player',
                                     value=orjson.dumps(json_data),
                                     key=clan_tag.encode('utf-8'),
-                                    timestamp_ms=int(
-                                        pend.now(tz=pend.UTC).timestamp()
-                                    )
-                                    * 1000,
                                 )
 
                             def to_regular_dict(d):
@@ -612,6 +617,7 @@ async def main():
                 await pipe.execute()
                 logger.info(f'LOOP {loop_spot}: Changes Found')
 
+            producer.log_stats()
             logger.info(f'{len(bulk_db_changes)} db changes')
             if bulk_db_changes:
                 await db_client.player_stats.bulk_write(bulk_db_changes)
@@ -8,12 +8,12 @@ import orjson
 import pendulum as pend
 import snappy
 from asyncio_throttle import Throttler
-from kafka import KafkaProducer
 from msgspec import Struct
 from msgspec.json import decode
 from pymongo import InsertOne, UpdateOne
 
 from utility.classes import MongoDatabase
+from utility.producer import AsyncKafkaProducer
 from utility.utils import (
     gen_games_season,
     gen_legend_date,
@@ -178,7 +178,7 @@ def get_player_changes(previous_response: dict, response: dict):
 
 
 def find_and_list_changes(
-    producer: KafkaProducer,
+    producer: AsyncKafkaProducer,
     response: dict,
     previous_response: dict,
     bulk_db_changes: list,
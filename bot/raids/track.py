@@ -1,16 +1,30 @@
 import asyncio
 
 import coc
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
 from tracking import Tracking
 from utility.config import TrackingType
 
 # Global cache for clans
 CLAN_CACHE = {}
+# chunks of cached raids prefetched ahead of the workers
+PREFETCH_AHEAD = 2
 
 
 class RaidTracker(Tracking):
-    """Class to manage raid weekend tracking."""
+    """
+    Class to manage raid weekend tracking.
+
+    The clans of a loop are split into chunks of `batch_size`. The cached
+    raids of a chunk are prefetched with one `$in` query, up to
+    PREFETCH_AHEAD chunks ahead of the workers, and changed raids are
+    written back with one unordered bulk_write per `batch_size` changes,
+    so Mongo round trips scale with batches instead of clans. A clan's
+    events are only sent once its raid is written; if the write fails, the
+    cached raid stays stale and the events are sent again next loop.
+    """
 
     def __init__(self, tracker_type: TrackingType, max_concurrent_requests=1000):
         # Call the parent class constructor
@@ -18,22 +32,144 @@ class RaidTracker(Tracking):
             max_concurrent_requests=max_concurrent_requests,
             tracker_type=tracker_type,
         )
+        self.chunks: list[list[str]] = []
+        self.chunk_of: dict[str, int] = {}
+        self.chunk_remaining: dict[int, int] = {}
+        self.prefetches: dict[int, asyncio.Task] = {}
+        self.items_remaining = 0
+        self.raid_updates: dict[str, UpdateOne] = {}
+        # clan tag -> events waiting on the write of the clan's raid
+        self.raid_events: dict[str, list[dict]] = {}
+        self.mongo_round_trips = 0
+
+    async def track(self, items):
+        """Track clans with prefetched cached raids and batched writes."""
+        self.mongo_round_trips = 0
+        self.chunks = [
+            items[i : i + self.batch_size]
+            for i in range(0, len(items), self.batch_size)
+        ]
+        self.chunk_of = {
+            tag: index
+            for index, chunk in enumerate(self.chunks)
+            for tag in chunk
+        }
+        self.chunk_remaining = {
+            index: len(chunk) for index, chunk in enumerate(self.chunks)
+        }
+        self.items_remaining = len(items)
+        self.raid_updates = {}
+        self.raid_events = {}
+        try:
+            await super().track(items)
+        finally:
+            for task in self.prefetches.values():
+                task.cancel()
+            self.prefetches.clear()
+            # only left over if the loop was cut short
+            await self._flush_raid_updates()
+        self.logger.info(
+            f'Raids: {self.mongo_round_trips} mongo round trips for {len(items)} clans'
+        )
+
+    def _loop_counters(self) -> dict:
+        counters = super()._loop_counters()
+        counters['mongo_round_trips'] = self.mongo_round_trips
+        return counters
+
+    def _prefetch(self, index: int) -> asyncio.Task:
+        """The prefetch of chunk `index`, starting the chunks after it too."""
+        for i in range(index, min(index + PREFETCH_AHEAD, len(self.chunks))):
+            if i not in self.prefetches and self.chunk_remaining[i]:
+                self.prefetches[i] = asyncio.create_task(
+                    self._load_cached_raids(self.chunks[i])
+                )
+        return self.prefetches[index]
+
+    async def _load_cached_raids(self, chunk: list[str]):
+        """Cached raid data of a chunk by clan tag, None if Mongo failed twice."""
+        for attempt in range(2):
+            try:
+                cached = await self.db_client.capital_cache.find(
+                    {'tag': {'$in': chunk}}, {'tag': 1, 'data': 1}
+                ).to_list(length=None)
+                self.mongo_round_trips += 1
+                return {
+                    raid['tag']: raid['data'] for raid in cached if 'data' in raid
+                }
+            except Exception as e:
+                self._handle_exception(
+                    f'Error prefetching cached raids of {len(chunk)} clans', e
+                )
+                if not attempt:
+                    await asyncio.sleep(1)
+        return None
+
+    def _item_done(self, clan_tag: str):
+        index = self.chunk_of[clan_tag]
+        self.chunk_remaining[index] -= 1
+        if not self.chunk_remaining[index]:
+            # free the chunk's cached raids
+            self.prefetches.pop(index, None)
+        self.items_remaining -= 1
+
+    async def _flush_raid_updates(self):
+        if not self.raid_updates:
+            return
+        updates, self.raid_updates = self.raid_updates, {}
+        events, self.raid_events = self.raid_events, {}
+        tags = list(updates)
+        failed = set()
+        try:
+            await self.db_client.capital_cache.bulk_write(
+                list(updates.values()), ordered=False
+            )
+        except BulkWriteError as e:
+            failed = {tags[error['index']] for error in e.details['writeErrors']}
+            self._handle_exception(
+                f'Error writing {len(failed)} of {len(tags)} raid updates', e
+            )
+        except Exception as e:
+            failed = set(tags)
+            self._handle_exception(
+                f'Error writing {len(updates)} raid updates', e
+            )
+        self.mongo_round_trips += 1
+        for clan_tag in tags:
+            if clan_tag in failed:
+                continue
+            for json_data in events.get(clan_tag, ()):
+                self._send_to_kafka('capital', clan_tag, json_data)
 
     async def _track_item(self, clan_tag):
         """Track updates for a specific clan's raid."""
+        prefetch = self._prefetch(self.chunk_of[clan_tag])
         try:
-            current_raid = await self._get_current_raid(clan_tag)
+            with self.tracer.span('fetch'):
+                current_raid = await self._get_current_raid(clan_tag)
             if not current_raid:
                 return
 
-            previous_raid = await self._get_previous_raid(clan_tag)
-            await self._process_raid_changes(
-                clan_tag, current_raid, previous_raid
-            )
+            with self.tracer.span('prefetch'):
+                cached_raids = await prefetch
+            if cached_raids is None:
+                return  # the chunk's prefetch failed, already logged
+            previous_raid = self._get_previous_raid(clan_tag, cached_raids)
+            with self.tracer.span('diff'):
+                await self._process_raid_changes(
+                    clan_tag, current_raid, previous_raid
+                )
         except Exception as e:
             self._handle_exception(
                 f'Error tracking raid for clan {clan_tag}', e
             )
+        finally:
+            self._item_done(clan_tag)
+            if (
+                len(self.raid_updates) >= self.batch_size
+                or not self.items_remaining
+            ):
+                await self._flush_raid_updates()
 
     async def _get_current_raid(self, clan_tag: str):
         """Get the current raid for a clan."""
@@ -50,14 +186,12 @@ class RaidTracker(Tracking):
             )
             return None
 
-    async def _get_previous_raid(self, clan_tag: str):
-        """Get the previous raid for a clan from the database."""
-        cached_raid = await self.db_client.capital_cache.find_one(
-            {'tag': clan_tag}
-        )
-        if cached_raid and 'data' in cached_raid:
+    def _get_previous_raid(self, clan_tag: str, cached_raids: dict):
+        """Get the previous raid for a clan from its chunk's prefetch."""
+        cached_raid = cached_raids.get(clan_tag)
+        if cached_raid is not None:
             return coc.RaidLogEntry(
-                data=cached_raid['data'],
+                data=cached_raid,
                 client=self.coc_client,
                 clan_tag=clan_tag,
             )
@@ -73,12 +207,13 @@ class RaidTracker(Tracking):
         if previous_raid and current_raid._raw_data == previous_raid._raw_data:
             return  # No changes
 
-        # Update the database with the current raid
-        await self.db_client.capital_cache.update_one(
+        # Written with the rest of the batch
+        self.raid_updates[clan_tag] = UpdateOne(
             {'tag': clan_tag},
             {'$set': {'data': current_raid._raw_data}},
             upsert=True,
         )
+        self.raid_events[clan_tag] = []
 
         if previous_raid:
             await self._detect_new_opponents(
@@ -100,7 +235,7 @@ class RaidTracker(Tracking):
         current_raid: coc.RaidLogEntry,
         previous_raid: coc.RaidLogEntry,
     ):
-        """Detect new offensive opponents and send to Kafka."""
+        """Detect new offensive opponents, sent with the batch."""
         new_opponents = (
             (
                 clan
@@ -118,7 +253,7 @@ class RaidTracker(Tracking):
                 'clan_tag': clan_tag,
                 'raid': current_raid._raw_data,
             }
-            self._send_to_kafka('capital', clan_tag, json_data)
+            self.raid_events[clan_tag].append(json_data)
 
     async def _detect_raid_state_changes(
         self,
@@ -126,7 +261,7 @@ class RaidTracker(Tracking):
         current_raid: coc.RaidLogEntry,
         previous_raid: coc.RaidLogEntry,
     ):
-        """Detect changes in the raid state and send to Kafka."""
+        """Detect changes in the raid state, sent with the batch."""
         if current_raid.state != previous_raid.state:
             json_data = {
                 'type': 'raid_state',
@@ -134,7 +269,7 @@ class RaidTracker(Tracking):
                 'old_raid': previous_raid._raw_data,
                 'raid': current_raid._raw_data,
             }
-            self._send_to_kafka('capital', clan_tag, json_data)
+            self.raid_events[clan_tag].append(json_data)
 
     async def _detect_member_attacks(
         self,
@@ -142,7 +277,7 @@ class RaidTracker(Tracking):
         current_raid: coc.RaidLogEntry,
         previous_raid: coc.RaidLogEntry,
     ):
-        """Detect member attack changes and send to Kafka."""
+        """Detect member attack changes, sent with the batch."""
         attacked = []
         for member in current_raid.members:
             old_member = coc.utils.get(previous_raid.members, tag=member.tag)
@@ -160,7 +295,7 @@ class RaidTracker(Tracking):
                 'raid': current_raid._raw_data,
                 'old_raid': previous_raid._raw_data,
             }
-            self._send_to_kafka('capital', clan_tag, json_data)
+            self.raid_events[clan_tag].append(json_data)
 
 
 if __name__ == '__main__':
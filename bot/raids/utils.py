@@ -4,10 +4,10 @@ from typing import Dict, List
 import coc
 import pendulum as pend
 import ujson
-from kafka import KafkaProducer
 from pymongo import UpdateOne
 
 from utility.classes import MongoDatabase
+from utility.producer import AsyncKafkaProducer
 
 CLAN_CACHE = {}
 
@@ -16,7 +16,7 @@ async def raid_weekend_track(
     clan_tags: List[str],
     db_client: MongoDatabase,
     coc_client: coc.Client,
-    producer: KafkaProducer,
+    producer: AsyncKafkaProducer,
 ):
     cached_raids = await db_client.capital_cache.find(
         {'tag': {'$in': clan_tags}}
@@ -1,40 +1,218 @@
 import asyncio
+import heapq
+import time
 
-import pendulum as pend
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from config import BotWarTrackingConfig
-from kafka import KafkaProducer
-from utils import clan_war_track
+from loguru import logger
+from utils import ReminderIndex, clan_war_track, send_reminder
 
 from utility.classes import MongoDatabase
+from utility.cwl import LeagueGroupCache
+from utility.producer import AsyncKafkaProducer
+from utility.timers import TimerService
 from utility.utils import initialize_coc_client
 
+# seconds until a clan is polled again, by the state of its current war
+POLL_INTERVALS = {
+    'inWar': 30,
+    'preparation': 300,
+    'warEnded': 600,
+    'notInWar': 900,
+}
+ERROR_INTERVAL = 300
+WORKERS = 100
+CLAN_REFRESH_INTERVAL = 300
+METRICS_INTERVAL = 60
+
+
+class WarPoller:
+    """
+    Polls every bot clan's war on its own schedule.
+
+    Each clan has a due time in a heap. A fixed pool of workers takes the
+    clans that are due, runs `clan_war_track` and pushes the clan back with
+    a due time based on the state of its war, so clans in war are polled
+    every few seconds and clans without a war every few minutes.
+    """
+
+    def __init__(self, db_client, coc_client, producer, redis, timers):
+        self.db_client = db_client
+        self.reminders = ReminderIndex(db_client.reminders)
+        self.coc_client = coc_client
+        self.producer = producer
+        self.redis = redis
+        self.timers = timers
+        self.league_groups = LeagueGroupCache(redis)
+        self.timers.register('war_reminder', self.send_reminders)
+        self.clans: set[str] = set()
+        self.due: list[tuple[float, str]] = []
+        # clan tag -> the due time of its one live heap entry, any other
+        # entry for the clan is stale and skipped when popped
+        self.next_due: dict[str, float] = {}
+        self.last_polled: dict[str, float] = {}
+        self.queue = asyncio.Queue()
+        self.metrics_since = time.monotonic()
+        self.polls = 0
+        self.poll_lag = []
+        self.attack_latency = []
+        self.in_war_cycle = []
+
+    async def refresh_clans(self):
+        clans = set(await self.db_client.clans_db.distinct('tag'))
+        now = time.monotonic()
+        for clan_tag in clans - self.clans:
+            # a clan re-added while it is queued or being polled keeps its
+            # current schedule
+            if clan_tag not in self.next_due:
+                self.schedule(clan_tag, now)
+        for clan_tag in self.clans - clans:
+            self.last_polled.pop(clan_tag, None)
+        # removed clans fall out of the heap when they come due
+        self.clans = clans
+
+    def schedule(self, clan_tag: str, due_at: float):
+        self.next_due[clan_tag] = due_at
+        heapq.heappush(self.due, (due_at, clan_tag))
+
+    async def refresh_loop(self):
+        while True:
+            try:
+                await self.refresh_clans()
+            except Exception as e:
+                logger.error(f'Error refreshing war clans: {e}')
+            await asyncio.sleep(CLAN_REFRESH_INTERVAL)
+
+    async def dispatch_loop(self):
+        """Move due clans from the heap onto the worker queue."""
+        while True:
+            now = time.monotonic()
+            while self.due and self.due[0][0] <= now:
+                due_at, clan_tag = heapq.heappop(self.due)
+                if self.next_due.get(clan_tag) != due_at:
+                    continue  # stale entry
+                if clan_tag in self.clans:
+                    # stays in next_due while queued or polled, so a re-add
+                    # can't schedule it a second time
+                    self.next_due[clan_tag] = None
+                    self.queue.put_nowait((due_at, clan_tag))
+                else:
+                    del self.next_due[clan_tag]
+            wait = self.due[0][0] - now if self.due else 1
+            await asyncio.sleep(min(max(wait, 0.05), 1))
+
+    async def worker(self):
+        while True:
+            due_at, clan_tag = await self.queue.get()
+            await self.producer.backpressure()
+            started = time.monotonic()
+            self.poll_lag.append(started - due_at)
+            try:
+                state, new_attacks, starts_in = await clan_war_track(
+                    clan_tag,
+                    self.db_client,
+                    self.coc_client,
+                    self.producer,
+                    self.redis,
+                    self.timers,
+                    self.reminders,
+                    self.league_groups,
+                )
+                interval = POLL_INTERVALS.get(state, ERROR_INTERVAL)
+                if starts_in is not None:
+                    # poll right as the war starts, not up to an interval late
+                    interval = min(interval, max(starts_in, 1))
+            except Exception as e:
+                logger.error(f'Error in war tracking for {clan_tag}: {e}')
+                state, new_attacks = None, 0
+                interval = ERROR_INTERVAL
+
+            previous_poll = self.last_polled.get(clan_tag)
+            if previous_poll is not None:
+                # an attack seen now happened at some point since the last
+                # poll, so this is the worst case time to notification
+                if new_attacks:
+                    self.attack_latency.append(started - previous_poll)
+                if state == 'inWar':
+                    self.in_war_cycle.append(started - previous_poll)
+            self.last_polled[clan_tag] = started
+            self.polls += 1
+
+            if clan_tag in self.clans:
+                self.schedule(clan_tag, started + interval)
+            else:
+                self.next_due.pop(clan_tag, None)
+            self.queue.task_done()
+
+    async def send_reminders(self, jobs: list):
+        await asyncio.gather(
+            *(
+                send_reminder(
+                    r_time, war_unique_id, clan_tag, self.producer, self.redis
+                )
+                for r_time, war_unique_id, clan_tag in jobs
+            )
+        )
+
+    async def metrics_loop(self):
+        while True:
+            await asyncio.sleep(METRICS_INTERVAL)
+            now = time.monotonic()
+            elapsed = now - self.metrics_since
+
+            def p(values, q):
+                if not values:
+                    return 0.0
+                values.sort()
+                return values[min(len(values) - 1, int(len(values) * q))]
+
+            logger.info(
+                f'WAR | {len(self.clans)} clans | {self.polls / elapsed:.1f} polls/s | '
+                f'queue {self.queue.qsize()} | '
+                f'poll lag p95 {p(self.poll_lag, 0.95):.1f}s | '
+                f'in war pass p50 {p(self.in_war_cycle, 0.5):.1f}s '
+                f'p95 {p(self.in_war_cycle, 0.95):.1f}s | '
+                f'attack latency p50 {p(self.attack_latency, 0.5):.1f}s '
+                f'p95 {p(self.attack_latency, 0.95):.1f}s'
+            )
+            self.producer.log_stats()
+            self.metrics_since = now
+            self.polls = 0
+            self.poll_lag.clear()
+            self.in_war_cycle.clear()
+            self.attack_latency.clear()
+
+    async def run(self):
+        await self.reminders.load()
+        await self.refresh_clans()
+        await asyncio.gather(
+            self.timers.run(),
+            self.reminders.run(),
+            self.refresh_loop(),
+            self.dispatch_loop(),
+            self.metrics_loop(),
+            *(self.worker() for _ in range(WORKERS)),
+        )
+
 
 async def main():
     """Main function for war tracking."""
     config = BotWarTrackingConfig()
-    scheduler = AsyncIOScheduler(timezone=pend.UTC)
-    scheduler.start()
+    redis = config.get_redis_client()
+    timers = TimerService(redis, key='timers:war_reminders')
 
-    producer = KafkaProducer(bootstrap_servers=['85.10.200.219:9092'])
+    producer = AsyncKafkaProducer()
+    await producer.start()
     db_client = MongoDatabase(
         stats_db_connection=config.stats_mongodb,
         static_db_connection=config.static_mongodb,
     )
     coc_client = await initialize_coc_client(config)
 
-    while True:
-        try:
-            # Fetch all clan tags from the database
-            clan_tags = await db_client.clans_db.distinct('tag')
-            for clan_tag in clan_tags:
-                await clan_war_track(
-                    clan_tag, db_client, coc_client, producer, scheduler
-                )
-            print('Finished war tracking for all clans.')
-        except Exception as e:
-            print(f'Error in war tracking: {e}')
-        await asyncio.sleep(300)  # Adjust interval as needed
+    poller = WarPoller(db_client, coc_client, producer, redis, timers)
+    try:
+        await poller.run()
+    finally:
+        await producer.stop()
 
 
 asyncio.run(main())
@@ -1,35 +1,198 @@
+import asyncio
+import time
+from bisect import bisect_right, insort
 from datetime import timedelta
 
+from typing import Optional, Tuple
+
 import coc
+import orjson
 import pendulum as pend
+import snappy
 import ujson
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from expiring_dict import ExpiringDict
-from kafka import KafkaProducer
+from loguru import logger
+from msgspec import Struct
 
 from utility.classes import MongoDatabase
+from utility.cwl import LeagueGroupCache
+from utility.producer import AsyncKafkaProducer
+from utility.timers import TimerService
 
-WAR_CACHE = ExpiringDict()
+# war id -> WarState, each entry expires WAR_STATE_GRACE after its war ends
+WAR_STATES = ExpiringDict()
+WAR_STATE_GRACE = 6 * 3600
 
 reminder_times = [
     f'{int(time)}hr' if time.is_integer() else f'{time}hr'
     for time in (x * 0.25 for x in range(1, 193))
 ]
+# reminder `time` values as stored in the reminders collection -> seconds before war end
+REMINDER_OFFSETS = {
+    f"{r_time.replace('hr', '')} hr": int(float(r_time.replace('hr', '')) * 3600)
+    for r_time in reminder_times
+}
+
+
+class ReminderIndex:
+    """
+    War reminder times per clan, kept in memory.
+
+    Loaded once from the reminders collection, then kept current from a
+    change stream. If change streams aren't available it reloads every
+    `reload_interval` seconds instead. Per clan the reminders are a sorted
+    list of (seconds before war end, time string), so the reminders that
+    still fit in a war are a bisect away.
+    """
+
+    def __init__(self, collection, reload_interval: int = 300):
+        self.collection = collection
+        self.reload_interval = reload_interval
+        self.by_clan: dict[str, list[tuple[int, str]]] = {}
+        self.entries: dict = {}  # reminder _id -> (clan, offset, time)
+
+    def _add(self, doc: dict):
+        offset = REMINDER_OFFSETS.get(doc.get('time'))
+        if doc.get('type') != 'War' or offset is None:
+            return
+        entry = (doc.get('clan'), offset, doc['time'])
+        self.entries[doc['_id']] = entry
+        insort(self.by_clan.setdefault(entry[0], []), entry[1:])
+
+    def _remove(self, _id):
+        entry = self.entries.pop(_id, None)
+        if entry is None:
+            return
+        reminders = self.by_clan.get(entry[0], [])
+        if entry[1:] in reminders:
+            reminders.remove(entry[1:])
+        if not reminders:
+            self.by_clan.pop(entry[0], None)
+
+    async def load(self):
+        docs = await self.collection.find(
+            {'type': 'War'}, {'clan': 1, 'time': 1, 'type': 1}
+        ).to_list(length=None)
+        self.by_clan, self.entries = {}, {}
+        for doc in docs:
+            self._add(doc)
+        logger.info(
+            f'Reminder index: {len(self.entries)} war reminders for {len(self.by_clan)} clans'
+        )
+
+    def apply(self, change: dict):
+        """Apply one change stream event."""
+        _id = change['documentKey']['_id']
+        self._remove(_id)
+        if change['operationType'] != 'delete' and change.get('fullDocument'):
+            self._add(change['fullDocument'])
+
+    async def run(self):
+        while True:
+            try:
+                async with self.collection.watch(
+                    full_document='updateLookup'
+                ) as stream:
+                    # anything changed between the load and the watch starting
+                    await self.load()
+                    async for change in stream:
+                        self.apply(change)
+            except Exception as e:
+                logger.warning(
+                    f'Reminder change stream unavailable ({e}), reloading in {self.reload_interval}s'
+                )
+                await asyncio.sleep(self.reload_interval)
+                try:
+                    await self.load()
+                except Exception as e:
+                    logger.error(f'Error reloading reminders: {e}')
+
+    def reminders_for(self, clan_tag: str, seconds_left: float) -> list[tuple[int, str]]:
+        """The clan's (offset, time) reminders that still fit before war end."""
+        reminders = self.by_clan.get(clan_tag)
+        if not reminders:
+            return []
+        return reminders[: bisect_right(reminders, (seconds_left, '\uffff'))]
+
+
+class WarState(Struct, gc=False):
+    """
+    What clan_war_track keeps between polls of a war.
+
+    Changes are detected from this compact state; the full war payload is
+    kept in Redis under `war_payload_key` and only loaded when an event
+    needs the previous war.
+    """
+
+    state: str
+    last_order: int
+    clan_members: Tuple[str, ...]
+    opponent_members: Tuple[str, ...]
+    raw_hash: int
+    end_time: int
+
+    @classmethod
+    def from_war(cls, war: coc.ClanWar, raw_hash: int) -> 'WarState':
+        return cls(
+            state=war.state,
+            last_order=last_attack_order(war),
+            clan_members=tuple(m.tag for m in war.clan.members),
+            opponent_members=tuple(m.tag for m in war.opponent.members),
+            raw_hash=raw_hash,
+            end_time=int(war.end_time.time.replace(tzinfo=pend.UTC).timestamp()),
+        )
 
 
-def send_reminder(
-    time: str, war_unique_id: str, clan_tag: str, producer: KafkaProducer
+def war_payload_key(war_unique_id: str) -> str:
+    return f'war:payload:{war_unique_id}'
+
+
+async def save_war(
+    redis,
+    war_unique_id: str,
+    war: coc.ClanWar,
+    league_group: Optional[dict],
+    raw_hash: int,
+) -> WarState:
+    """Cache the war's compact state and store its full payload in Redis."""
+    state = WarState.from_war(war, raw_hash)
+    ttl = max(state.end_time - int(pend.now(tz=pend.UTC).timestamp()), 0)
+    ttl += WAR_STATE_GRACE
+    payload = {'war': war._raw_data, 'league_group': league_group}
+    await redis.set(
+        war_payload_key(war_unique_id),
+        snappy.compress(orjson.dumps(payload)),
+        ex=ttl,
+    )
+    # only once the payload is stored, so a failed write is diffed again
+    WAR_STATES.ttl(war_unique_id, state, ttl)
+    return state
+
+
+async def load_war(redis, war_unique_id: str) -> Optional[dict]:
+    """The last stored `{'war', 'league_group'}` payload of a war, if any."""
+    payload = await redis.get(war_payload_key(war_unique_id))
+    if payload is None:
+        return None
+    return orjson.loads(snappy.decompress(payload))
+
+
+async def send_reminder(
+    time: str,
+    war_unique_id: str,
+    clan_tag: str,
+    producer: AsyncKafkaProducer,
+    redis,
 ):
-    global WAR_CACHE
-    war = WAR_CACHE.get(war_unique_id)
-    if war is None:
+    payload = await load_war(redis, war_unique_id)
+    if payload is None:
         return
 
     json_data = {
         'type': 'war',
         'clan_tag': clan_tag,
         'time': time,
-        'data': war._raw_data,
+        'data': payload['war'],
     }
     producer.send(
         'reminder',
@@ -39,16 +202,198 @@ def send_reminder(
     )
 
 
+def last_attack_order(war: coc.ClanWar) -> int:
+    """Highest attack order seen in `war`, 0 if nobody attacked yet."""
+    return max(
+        (
+            attack.order
+            for side in (war.clan, war.opponent)
+            for attack in side.attacks
+        ),
+        default=0,
+    )
+
+
+def attacks_after(war: coc.ClanWar, order: int) -> list[coc.WarAttack]:
+    """
+    Attacks in `war` with an order past `order`, newest first like `war.attacks`.
+
+    Attack order is monotonic within a war, so this is everything that
+    happened since the poll that saw `order`.
+    """
+    new_attacks = [
+        attack
+        for side in (war.clan, war.opponent)
+        for attack in side.attacks
+        if attack.order > order
+    ]
+    new_attacks.sort(key=lambda attack: attack.order, reverse=True)
+    return new_attacks
+
+
+def lineup_changes(
+    members: list[dict], previous_members: list[dict]
+) -> tuple[list, list]:
+    """Raw members added to and removed from a war lineup."""
+    tags = {member['tag'] for member in members}
+    previous_tags = {member['tag'] for member in previous_members}
+    added = [m for m in members if m['tag'] not in previous_tags]
+    removed = [m for m in previous_members if m['tag'] not in tags]
+    return added, removed
+
+
+async def league_group_entry(
+    clan_tag: str, coc_client: coc.Client, league_groups: LeagueGroupCache
+) -> Optional[dict]:
+    """The clan's cached league group entry, fetching the group when it's due."""
+    entry = await league_groups.get(clan_tag)
+    if entry is not None and not league_groups.is_due(entry):
+        return entry
+    try:
+        group = await coc_client.get_league_group(clan_tag)
+    except (coc.errors.NotFound, coc.errors.GatewayError):
+        # not in CWL, or the endpoint timing out while the clan is searching
+        return None
+    except Exception:
+        return entry
+    if group.state in ('notInWar', 'groupNotFound'):
+        return None
+    return await league_groups.put(
+        group._raw_data, war_tags=entry['war_tags'] if entry else None
+    )
+
+
+async def current_league_wars(
+    clan_tag: str, coc_client: coc.Client, league_groups: LeagueGroupCache
+) -> Tuple[Optional[coc.ClanWar], Optional[coc.ClanWar]]:
+    """
+    The clan's current CWL war and the war of the round in preparation.
+
+    Only the clan's own wars of the last two rounds are fetched; which war of
+    a round is the clan's is looked up once per group and round and shared
+    through the cache.
+    """
+    entry = await league_group_entry(clan_tag, coc_client, league_groups)
+    # an ended group has no war to track anymore
+    if entry is None or entry['group'].get('state') == 'ended':
+        return None, None
+    group = coc.ClanWarLeagueGroup(data=entry['group'], client=coc_client)
+    rounds = [str(i) for i in range(len(group.rounds))][-2:]
+    if not rounds:
+        return None, None
+
+    fetched = {}
+    if any(r not in entry['war_tags'] for r in rounds):
+        group_id = league_groups.id_of(entry)
+        async with league_groups.lock(group_id):
+            # another clan of the group may have mapped the rounds meanwhile
+            entry = await league_groups.get(clan_tag) or entry
+            war_tags = dict(entry['war_tags'])
+            for r in rounds:
+                if r in war_tags:
+                    continue
+                wars = await asyncio.gather(
+                    *(
+                        coc_client.get_league_war(war_tag)
+                        for war_tag in group.rounds[int(r)]
+                    ),
+                    return_exceptions=True,
+                )
+                mapping = {}
+                for war in wars:
+                    if isinstance(war, coc.ClanWar):
+                        fetched[war.war_tag] = war._raw_data
+                        mapping[war.clan.tag] = war.war_tag
+                        mapping[war.opponent.tag] = war.war_tag
+                war_tags[r] = mapping
+            entry = await league_groups.update(entry, war_tags=war_tags)
+
+    wars = []
+    for r in rounds:
+        war_tag = entry['war_tags'][r].get(clan_tag)
+        if war_tag is None:
+            continue
+        if war_tag in fetched:
+            war = coc.ClanWar(
+                data=fetched[war_tag],
+                client=coc_client,
+                clan_tag=clan_tag,
+                league_group=group,
+            )
+        else:
+            war = await coc_client.get_league_war(
+                war_tag, clan_tag=clan_tag, league_group=group
+            )
+        wars.append(war)
+    if not wars:
+        return None, None
+
+    latest = wars[-1]
+    if latest.state == 'preparation' and len(wars) > 1:
+        current, next_round = wars[0], latest
+    else:
+        current, next_round = latest, None
+
+    # the next round's war tags show up once the latest round starts, and
+    # after the last round the group only changes to ended
+    if len(group.rounds) < group.number_of_rounds:
+        refresh_at = max(latest.start_time.time.timestamp(), time.time() + 60)
+    else:
+        refresh_at = max(latest.end_time.time.timestamp(), time.time() + 60)
+    if entry['refresh_at'] is None or (
+        abs(entry['refresh_at'] - refresh_at) > 60
+    ):
+        await league_groups.update(entry, refresh_at=refresh_at)
+    return current, next_round
+
+
+async def current_wars(
+    clan_tag: str, coc_client: coc.Client, league_groups: LeagueGroupCache
+) -> Tuple[Optional[coc.ClanWar], Optional[coc.ClanWar]]:
+    """
+    `coc.Client.get_current_war` with the league group from the cache.
+
+    Returns the current war and, in CWL, the war of the round in
+    preparation. Raises PrivateWarLog like coc does when the war log is
+    private and the clan isn't in CWL.
+    """
+    private = None
+    try:
+        war = await coc_client.get_clan_war(clan_tag)
+    except coc.errors.PrivateWarLog as e:
+        war, private = None, e
+    if war is not None and war.state != 'notInWar':
+        return war, None
+
+    current, next_round = await current_league_wars(
+        clan_tag, coc_client, league_groups
+    )
+    if current is None and private is not None:
+        raise private
+    return current or war, next_round
+
+
 async def clan_war_track(
     clan_tag: str,
     db_client: MongoDatabase,
     coc_client: coc.Client,
-    producer: KafkaProducer,
-    scheduler: AsyncIOScheduler,
+    producer: AsyncKafkaProducer,
+    redis,
+    timers: TimerService,
+    reminders: ReminderIndex,
+    league_groups: LeagueGroupCache,
 ):
-    war = None
+    """
+    Poll a clan's current war (and the next CWL round) and emit the changes.
+
+    Returns the state of the current war, None if it couldn't be fetched,
+    the number of new attacks sent and, for a war in preparation, the
+    seconds until it starts, which the poller uses to schedule the clan's
+    next poll.
+    """
+    war, next_round = None, None
     try:
-        war = await coc_client.get_current_war(clan_tag=clan_tag)
+        war, next_round = await current_wars(clan_tag, coc_client, league_groups)
     except coc.errors.PrivateWarLog:
         result = (
             await db_client.clan_wars.find(
@@ -67,27 +412,18 @@ async def clan_war_track(
             result = result[0]
             other_clan = result.get('clans', []).remove(clan_tag)
             try:
-                war = await coc_client.get_current_war(clan_tag=other_clan)
+                war, _ = await current_wars(other_clan, coc_client, league_groups)
             except coc.errors.PrivateWarLog:
                 pass
     except Exception:
         war = None
 
-    next_round = None
-    if (
-        war is not None
-        and war.is_cwl
-        and war.state != 'inPreparation'
-        and war.league_group.state != 'ended'
-    ):
-        try:
-            next_round = await coc_client.get_current_war(
-                clan_tag=clan_tag, cwl_round=coc.WarRound.current_preparation
-            )
-        except Exception:
-            pass
-
     war_list = [w for w in [war, next_round] if w is not None]
+    state = war.state if war is not None else None
+    starts_in = None
+    if state == 'preparation' and war.start_time is not None:
+        starts_in = war.start_time.seconds_until
+    attack_count = 0
 
     for war in war_list:
         # notInWar state, skip
@@ -99,110 +435,84 @@ async def clan_war_track(
             + f'-{int(war.preparation_start_time.time.timestamp())}'
         )
 
-        previous_war = WAR_CACHE.get(war_unique_id)
-        if previous_war is None:
-            WAR_CACHE[war_unique_id] = war
-
-            acceptable_times = []
-            for r_time in reversed(reminder_times):
-                time = r_time.replace('hr', '')
-                time_seconds = int(float(time) * 3600)
-                if war.end_time.seconds_until >= time_seconds:
-                    future_time = war.end_time.time.replace(
-                        tzinfo=pend.UTC
-                    ) - timedelta(seconds=time_seconds)
-                    acceptable_times.append((future_time, f'{time} hr'))
-            set_times = await db_client.reminders.distinct(
-                'time', filter={'$and': [{'clan': clan_tag}, {'type': 'War'}]}
-            )
-            if acceptable_times:
-                for future_time, r_time in acceptable_times:
-                    if r_time in set_times:
-                        scheduler.add_job(
-                            send_reminder,
-                            'date',
-                            run_date=future_time,
-                            args=[r_time, war_unique_id, clan_tag, producer],
-                            id=f'war_end_{war.clan.tag}_{war.opponent.tag}_{future_time.timestamp()}',
-                            misfire_grace_time=1200,
-                            max_instances=1,
-                        )
+        raw_hash = hash(orjson.dumps(war._raw_data))
+        previous = WAR_STATES.get(war_unique_id)
+        if previous is not None and raw_hash == previous.raw_hash:
             continue
 
-        if war._raw_data == previous_war._raw_data:
-            continue
+        league_group = None
+        if war.is_cwl and war.league_group is not None:
+            league_group = war.league_group._raw_data
 
-        WAR_CACHE[war_unique_id] = war
-
-        if war.is_cwl and war.state == 'inPreparation':
-            clan_members_added = [
-                n._raw_data
-                for n in war.clan.members
-                if n.tag not in set(n.tag for n in previous_war.clan.members)
-            ]
-            clan_members_removed = [
-                n._raw_data
-                for n in previous_war.clan.members
-                if n.tag not in set(n.tag for n in war.clan.members)
-            ]
-
-            if clan_members_added or clan_members_removed:
-                json_data = {
-                    'type': 'cwl_lineup_change',
-                    'war': war._raw_data,
-                    'league_group': league_group,
-                    'added': clan_members_added,
-                    'removed': clan_members_removed,
-                    'clan_tag': war.clan.tag,
+        # the previous payload is only loaded when an event needs it, and
+        # before save_war overwrites it
+        previous_payload = None
+        if previous is not None:
+            lineup_changed = (
+                war.is_cwl
+                and war.state == 'preparation'
+                and (
+                    {m.tag for m in war.clan.members}
+                    != set(previous.clan_members)
+                    or {m.tag for m in war.opponent.members}
+                    != set(previous.opponent_members)
+                )
+            )
+            if lineup_changed or war.state != previous.state:
+                previous_payload = await load_war(redis, war_unique_id) or {
+                    'war': None,
+                    'league_group': None,
                 }
-                producer.send(
-                    'war',
-                    ujson.dumps(json_data).encode('utf-8'),
-                    key=clan_tag.encode('utf-8'),
-                    timestamp_ms=int(pend.now(tz=pend.UTC).timestamp() * 1000),
+
+        await save_war(redis, war_unique_id, war, league_group, raw_hash)
+
+        if previous is None:
+            # reminder ids are stable, so seeing a war again after a restart
+            # just reschedules the same jobs
+            end_time = war.end_time.time.replace(tzinfo=pend.UTC)
+            for time_seconds, r_time in reminders.reminders_for(
+                clan_tag, war.end_time.seconds_until
+            ):
+                future_time = end_time - timedelta(seconds=time_seconds)
+                await timers.schedule(
+                    f'war_end_{war.clan.tag}_{war.opponent.tag}_{future_time.timestamp()}',
+                    'war_reminder',
+                    future_time.timestamp(),
+                    [r_time, war_unique_id, clan_tag],
+                    grace=1200,
                 )
+            continue
 
-            opponent_members_added = [
-                n._raw_data
-                for n in war.opponent.members
-                if n.tag
-                not in set(n.tag for n in previous_war.opponent.members)
-            ]
-            opponent_members_removed = [
-                n._raw_data
-                for n in previous_war.opponent.members
-                if n.tag not in set(n.tag for n in war.opponent.members)
-            ]
-
-            if opponent_members_added or opponent_members_removed:
-                json_data = {
-                    'type': 'cwl_lineup_change',
-                    'war': war._raw_data,
-                    'league_group': league_group,
-                    'added': opponent_members_added,
-                    'removed': opponent_members_removed,
-                    'clan_tag': war.opponent.tag,
-                }
-                producer.send(
-                    'war',
-                    ujson.dumps(json_data).encode('utf-8'),
-                    key=clan_tag.encode('utf-8'),
-                    timestamp_ms=int(pend.now(tz=pend.UTC).timestamp() * 1000),
+        if war.is_cwl and war.state == 'preparation' and previous_payload:
+            old_war = previous_payload['war'] or {}
+            for side in ('clan', 'opponent'):
+                added, removed = lineup_changes(
+                    war._raw_data.get(side, {}).get('members', []),
+                    old_war.get(side, {}).get('members', []),
                 )
 
-        league_group = None
-        if war.is_cwl:
-            league_group: coc.ClanWarLeagueGroup | None = war.league_group
-            league_group = league_group._raw_data
-
-        if previous_war.attacks:
-            new_attacks = [
-                a for a in war.attacks if a not in set(previous_war.attacks)
-            ]
-        else:
-            new_attacks = war.attacks
+                if added or removed:
+                    json_data = {
+                        'type': 'cwl_lineup_change',
+                        'war': war._raw_data,
+                        'league_group': league_group,
+                        'added': added,
+                        'removed': removed,
+                        'clan_tag': getattr(war, side).tag,
+                    }
+                    producer.send(
+                        'war',
+                        ujson.dumps(json_data).encode('utf-8'),
+                        key=clan_tag.encode('utf-8'),
+                        timestamp_ms=int(
+                            pend.now(tz=pend.UTC).timestamp() * 1000
+                        ),
+                    )
+
+        new_attacks = attacks_after(war, previous.last_order)
 
         if new_attacks:
+            attack_count += len(new_attacks)
             json_data = {
                 'type': 'new_attacks',
                 'war': war._raw_data,
@@ -217,19 +527,12 @@ async def clan_war_track(
                 timestamp_ms=int(pend.now(tz=pend.UTC).timestamp() * 1000),
             )
 
-        previous_league_group = None
-        if previous_war.is_cwl:
-            previous_league_group: coc.ClanWarLeagueGroup | None = (
-                previous_war.league_group
-            )
-            previous_league_group = previous_league_group._raw_data
-
-        if war.state != previous_war.state:
+        if war.state != previous.state:
             json_data = {
                 'type': 'war_state',
-                'old_war': previous_war._raw_data,
+                'old_war': previous_payload['war'],
                 'new_war': war._raw_data,
-                'previous_league_group': previous_league_group,
+                'previous_league_group': previous_payload['league_group'],
                 'new_league_group': league_group,
                 'clan_tag': clan_tag,
             }
@@ -239,3 +542,5 @@ async def clan_war_track(
                 key=clan_tag.encode('utf-8'),
                 timestamp_ms=int(pend.now(tz=pend.UTC).timestamp() * 1000),
             )
+
+    return state, attack_count, starts_in
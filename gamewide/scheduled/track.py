@@ -14,6 +14,7 @@ from hashids import Hashids
 from pymongo import InsertOne, UpdateOne
 from utility.constants import locations
 from utility.config import TrackingType
+from utility.cwl import LeagueGroupCache, cwl_id
 '''from .capital_lb import (
     calculate_clan_capital_leaderboards,
     calculate_player_capital_looted_leaderboards,
@@ -337,8 +338,20 @@ class ScheduledTracking(Tracking):
                 for i in range(0, len(all_tags), size_break)
             ]
 
+            league_groups = LeagueGroupCache(self.redis)
             was_found_in_a_previous_group = set()
             for tag_group in all_tags:
+                # groups the war trackers fetched recently come from the
+                # shared cache instead of another request per clan
+                cached_groups = []
+                cached = await league_groups.get_many(tag_group, season=season)
+                for tag, entry in cached.items():
+                    if tag in was_found_in_a_previous_group or league_groups.is_due(entry):
+                        continue
+                    cached_groups.append(entry['group'])
+                    for clan in entry['group'].get('clans', []):
+                        was_found_in_a_previous_group.add(clan.get('tag'))
+
                 tasks = []
                 connector = aiohttp.TCPConnector(limit=250, ttl_dns_cache=300)
                 timeout = aiohttp.ClientTimeout(total=1800)
@@ -362,21 +375,25 @@ class ScheduledTracking(Tracking):
 
                 changes = []
                 responses = [r for r in responses if isinstance(r, tuple) and r[0] is not None]
+                fetched = [response for response, _ in responses if response.get('clans')]
+                for i in range(0, len(fetched), 1000):
+                    await asyncio.gather(
+                        *(league_groups.put(group) for group in fetched[i: i + 1000]),
+                        return_exceptions=True,
+                    )
+                responses += [(group, None) for group in cached_groups]
                 for response, tag in responses:
                     try:
                         season = response.get('season')
                         for clan in response.get('clans', []):
                             was_found_in_a_previous_group.add(clan.get('tag'))
-                        tags = sorted(
-                            [
-                                clan.get('tag').replace('#', '')
-                                for clan in response.get('clans', [])
-                            ]
+                        group_id = cwl_id(
+                            season,
+                            [clan.get('tag') for clan in response.get('clans', [])],
                         )
-                        cwl_id = f"{season}-{'-'.join(tags)}"
                         changes.append(
                             UpdateOne(
-                                {'cwl_id': cwl_id},
+                                {'cwl_id': group_id},
                                 {'$set': {'data': response}},
                                 upsert=True,
                             )
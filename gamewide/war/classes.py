@@ -0,0 +1,37 @@
+from typing import List, Optional
+
+from msgspec import Raw, Struct
+from msgspec.json import Decoder, decode
+
+NULL = Raw(b'null')
+
+
+class Members(Struct):
+    tag: str
+
+
+class Clan(Struct, gc=False):
+    """
+    A side of a war, with its member list left as raw JSON.
+
+    Only brand-new wars need the member tags, so `members` is decoded on
+    demand by `member_tags`. notInWar bodies have both sides without a tag.
+    """
+
+    tag: Optional[str] = None
+    members: Raw = NULL
+
+    def member_tags(self) -> List[str]:
+        members = decode(self.members, type=Optional[List[Members]]) or []
+        return [member.tag for member in members]
+
+
+class War(Struct, gc=False):
+    state: str
+    preparationStartTime: Optional[str] = None
+    endTime: Optional[str] = None
+    clan: Optional[Clan] = None
+    opponent: Optional[Clan] = None
+
+
+war_decoder = Decoder(War)
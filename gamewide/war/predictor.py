@@ -0,0 +1,101 @@
+import statistics
+import time
+
+from loguru import logger
+
+HISTORY_DAYS = 30
+# a clan needs this many idle gaps before its polls are predicted
+MIN_GAPS = 2
+# the dense window around an expected war start is never narrower than this
+MIN_WINDOW = 1800
+# clans outside their window are still polled this often
+SPARSE_INTERVAL = 3 * 3600
+
+
+class WarStartPredictor:
+    """
+    Predicts when a clan starts its next war from its war history.
+
+    From the last HISTORY_DAYS of clan_wars it learns, per clan, the end of
+    its last war and its typical idle gap, the median time between a war
+    ending and the next one's preparation starting. Near the expected start
+    (the median gap after the last war, give or take the median absolute
+    deviation of the gaps) the clan is polled every pass; outside that
+    window only every SPARSE_INTERVAL. Clans with too little history are
+    polled every pass.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        # clan tag -> (last war end, median gap, window half width)
+        self.models: dict[str, tuple[float, float, float]] = {}
+        self.last_polled: dict[str, float] = {}
+        self.skipped = 0
+
+    async def load(self):
+        since = int(time.time()) - HISTORY_DAYS * 86400
+        pipeline = [
+            {
+                '$match': {
+                    '$and': [
+                        {'endTime': {'$gte': since}},
+                        {'type': {'$ne': 'cwl'}},
+                    ]
+                }
+            },
+            {'$project': {'_id': 0, 'clans': 1, 'war_id': 1, 'endTime': 1}},
+            {'$unwind': '$clans'},
+            {
+                '$group': {
+                    '_id': '$clans',
+                    'wars': {'$addToSet': {'id': '$war_id', 'end': '$endTime'}},
+                }
+            },
+        ]
+        models = {}
+        async for clan in self.collection.aggregate(pipeline):
+            wars = []
+            for war in clan['wars']:
+                try:
+                    prep = int(war['id'].rsplit('-', 1)[-1])
+                except (AttributeError, ValueError):
+                    continue
+                wars.append((prep, war['end']))
+            model = self.fit(wars)
+            if model is not None:
+                models[clan['_id']] = model
+        self.models = models
+        logger.info(f'War start predictions for {len(models)} clans')
+
+    @staticmethod
+    def fit(wars: list[tuple[int, int]]):
+        """(last end, median gap, window) from a clan's (prep, end) times."""
+        wars = sorted(set(wars))
+        gaps = [
+            max(0, wars[i + 1][0] - wars[i][1]) for i in range(len(wars) - 1)
+        ]
+        if len(gaps) < MIN_GAPS:
+            return None
+        gap = statistics.median(gaps)
+        spread = statistics.median(abs(g - gap) for g in gaps)
+        return wars[-1][1], gap, max(spread, MIN_WINDOW)
+
+    def observe(self, clan_tag: str, prep: float, end: float):
+        """A war found this pass moves the clan's prediction past it."""
+        model = self.models.get(clan_tag)
+        if model is not None and end > model[0]:
+            self.models[clan_tag] = (end,) + model[1:]
+
+    def due(self, clan_tag: str, now: float = None) -> bool:
+        """Whether to poll the clan this pass; a due clan counts as polled."""
+        now = now or time.time()
+        model = self.models.get(clan_tag)
+        if model is not None:
+            last_end, gap, window = model
+            expected = last_end + gap
+            in_window = expected - window <= now <= expected + window
+            if not in_window and now - self.last_polled.get(clan_tag, 0) < SPARSE_INTERVAL:
+                self.skipped += 1
+                return False
+        self.last_polled[clan_tag] = now
+        return True
@@ -0,0 +1,51 @@
+import time
+
+from loguru import logger
+
+
+class InWarRegistry:
+    """
+    The clans that are in a war right now, kept in a Redis sorted set.
+
+    Each clan is scored by the end time of its war, so a clan leaves the
+    registry when its war ends, and pruning is a single ZREMRANGEBYSCORE.
+    The set is shared by every tracker replica and survives restarts; each
+    replica keeps a local copy, refreshed once per discovery pass, that
+    membership checks go to.
+    """
+
+    def __init__(self, redis, key: str = 'war:in_war'):
+        self.redis = redis
+        self.key = key
+        self.ends: dict[str, float] = {}  # clan tag -> war end timestamp
+
+    def __contains__(self, clan_tag: str) -> bool:
+        end = self.ends.get(clan_tag)
+        return end is not None and end > time.time()
+
+    def __len__(self) -> int:
+        return len(self.ends)
+
+    async def refresh(self):
+        """Drop ended wars and reload the registry from Redis."""
+        now = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.zremrangebyscore(self.key, '-inf', now)
+            pipe.zrangebyscore(self.key, now, '+inf', withscores=True)
+            pruned, members = await pipe.execute()
+        self.ends = {
+            tag.decode() if isinstance(tag, bytes) else tag: end
+            for tag, end in members
+        }
+        if pruned:
+            logger.info(f'{pruned} clans left the in war registry')
+
+    async def add(self, ends: dict[str, float]):
+        """Register clans with the end time of their war."""
+        if not ends:
+            return
+        # GT so an older poll from another replica can't shorten a war
+        await self.redis.zadd(self.key, ends, gt=True)
+        for tag, end in ends.items():
+            if end > self.ends.get(tag, 0):
+                self.ends[tag] = end
@@ -6,12 +6,13 @@ import coc
 import pendulum as pend
 import ujson
 from aiokafka import AIOKafkaConsumer
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from hashids import Hashids
 from loguru import logger
+from pymongo import UpdateOne
 
 from utility.classes import MongoDatabase
 from utility.keycreation import create_keys
+from utility.timers import TimerService
 
 from .config import GlobalWarTrackingConfig
 
@@ -30,7 +31,17 @@ db_client = MongoDatabase(
 )
 
 
-async def store(scheduler: AsyncIOScheduler):
+MAINTENANCE_WAIT = 15 * 60
+MAX_TRIES = 10
+hashids = Hashids(min_length=7)
+
+
+def store_job_id(clan_tag: str, opponent_tag: str, prep_time: int) -> str:
+    # both clans of a war report it, the sorted tags dedupe them
+    return f"war_store_{'-'.join(sorted([clan_tag, opponent_tag]))}_{prep_time}"
+
+
+async def store(timers: TimerService):
 
     keys = await create_keys(
         [config.coc_email.format(x=x) for x in range(39, 40 + 1)],
@@ -49,131 +60,159 @@ async def store(scheduler: AsyncIOScheduler):
     logger.info('Events Started')
     async for msg in consumer:
         msg = ujson.loads(msg.value)
-        run_time = pend.from_timestamp(
-            timestamp=msg.get('run_time'), tz=pend.UTC
-        )
         try:
-            scheduler.add_job(
-                store_war,
-                'date',
-                run_date=run_time,
-                args=[
-                    msg.get('tag'),
-                    msg.get('opponent_tag'),
-                    msg.get('prep_time'),
-                ],
-                misfire_grace_time=None,
-                max_instances=1,
+            await timers.schedule(
+                store_job_id(
+                    msg.get('tag'), msg.get('opponent_tag'), msg.get('prep_time')
+                ),
+                'war_store',
+                msg.get('run_time'),
+                [msg.get('tag'), msg.get('opponent_tag'), msg.get('prep_time')],
             )
-        except Exception:
-            pass
+        except Exception as e:
+            logger.error(f'Error scheduling war store: {e}')
 
 
-async def store_war(clan_tag: str, opponent_tag: str, prep_time: int):
-    hashids = Hashids(min_length=7)
+class WarStoreBatcher:
+    """
+    Stores ended wars in batches.
 
-    async def find_active_war(
-        clan_tag: str, opponent_tag: str, prep_time: int
+    Due war_store timers are collected for `window` seconds, so the wars
+    that end together at the top of the hour make one batch. A batch is
+    fetched with at most `concurrency` requests in flight and written with
+    a single unordered bulk_write. Maintenance pauses every fetch at once
+    until it's over; wars that haven't ended yet go back on the timers.
+    """
+
+    def __init__(
+        self, timers: TimerService, concurrency: int = 100, window: float = 5
     ):
-        async def get_war(clan_tag: str):
-            try:
-                war = await coc_client.get_clan_war(clan_tag=clan_tag)
-                return war
-            except (
-                coc.NotFound,
-                coc.errors.Forbidden,
-                coc.errors.PrivateWarLog,
-            ):
-                return 'no access'
-            except coc.errors.Maintenance:
-                return 'maintenance'
-            except Exception as e:
-                logger.error(str(e))
-                return 'error'
+        self.timers = timers
+        self.window = window
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.available = asyncio.Event()
+        self.available.set()
+        self.pending: list = []
+
+    async def add(self, jobs: list):
+        """war_store timer handler."""
+        self.pending.extend(jobs)
+
+    def pause_for_maintenance(self):
+        if self.available.is_set():
+            logger.warning('API maintenance, pausing war storage')
+            self.available.clear()
+            asyncio.get_running_loop().call_later(
+                MAINTENANCE_WAIT, self.available.set
+            )
 
-        switched = False
-        tries = 0
+    async def get_war(self, clan_tag: str):
         while True:
-            war = await get_war(clan_tag=clan_tag)
-
-            if isinstance(war, coc.ClanWar):
-                if war.state == 'warEnded':
-                    return war  # Found the completed war
-                # Check prep time and retry if needed
-                if (
-                    war.preparation_start_time is None
-                    or int(
-                        war.preparation_start_time.time.replace(
-                            tzinfo=pend.UTC
-                        ).timestamp()
-                    )
-                    != prep_time
+            await self.available.wait()
+            async with self.semaphore:
+                try:
+                    return await coc_client.get_clan_war(clan_tag=clan_tag)
+                except (
+                    coc.NotFound,
+                    coc.errors.Forbidden,
+                    coc.errors.PrivateWarLog,
                 ):
-                    if not switched:
-                        clan_tag = opponent_tag
-                        switched = True
-                        continue  # Try with the opponent's tag
-                    else:
-                        return None  # Both tags checked, no valid war found
-            elif war == 'maintenance':
-                await asyncio.sleep(
-                    15 * 60
-                )  # Wait 15 minutes for maintenance, then continue loop
-                continue
-            elif war == 'error':
-                break  # Stop on error
-            elif war == 'no access':
-                if not switched:
-                    clan_tag = opponent_tag
-                    switched = True
-                    continue  # Access issue, switch clan tag
-                else:
-                    return None  # Both tags checked, no access to either
-
-            await asyncio.sleep(
-                min(war._response_retry, 120)
-            )  # Wait before retry based on response retry attribute
-            tries += 1
-            if tries == 10:
-                break
-
+                    return 'no access'
+                except coc.errors.Maintenance:
+                    self.pause_for_maintenance()
+                except Exception as e:
+                    logger.error(str(e))
+                    return 'error'
+
+    async def find_ended_war(
+        self, clan_tag: str, opponent_tag: str, prep_time: int, tries: int = 0
+    ):
+        """The ended war, or None; retries later when it hasn't ended yet."""
+        for tag in (clan_tag, opponent_tag):
+            war = await self.get_war(clan_tag=tag)
+            if war == 'error':
+                return None
+            if war == 'no access':
+                continue  # try the opponent's side
+            if war.state == 'warEnded':
+                return war
+            if (
+                war.preparation_start_time is None
+                or int(
+                    war.preparation_start_time.time.replace(
+                        tzinfo=pend.UTC
+                    ).timestamp()
+                )
+                != prep_time
+            ):
+                continue  # a different war, try the opponent's side
+            if tries + 1 < MAX_TRIES:
+                await self.timers.schedule(
+                    store_job_id(clan_tag, opponent_tag, prep_time),
+                    'war_store',
+                    pend.now(tz=pend.UTC).timestamp()
+                    + min(war._response_retry, 120),
+                    [clan_tag, opponent_tag, prep_time, tries + 1],
+                )
+            return None
         return None
 
-    war = await find_active_war(
-        clan_tag=clan_tag, opponent_tag=opponent_tag, prep_time=prep_time
-    )
-
-    if war is None:
-        return
-
-    war_unique_id = (
-        '-'.join(sorted([war.clan.tag, war.opponent.tag]))
-        + f'-{int(war.preparation_start_time.time.replace(tzinfo=pend.UTC).timestamp())}'
-    )
-
-    custom_id = hashids.encode(
-        int(
-            war.preparation_start_time.time.replace(
-                tzinfo=pend.UTC
-            ).timestamp()
+    async def store_batch(self, jobs: list):
+        wars = await asyncio.gather(
+            *(self.find_ended_war(*args) for args in jobs),
+            return_exceptions=True,
         )
-        + int(pend.now(tz=pend.UTC).timestamp())
-        + random.randint(1000000000, 9999999999)
-    )
-    await db_client.clan_wars.update_one(
-        {'war_id': war_unique_id},
-        {
-            '$set': {
-                'custom_id': custom_id,
-                'data': war._raw_data,
-                'type': war.type,
-            }
-        },
-        upsert=True,
-    )
+        changes = []
+        for war in wars:
+            if not isinstance(war, coc.ClanWar):
+                if isinstance(war, Exception):
+                    logger.error(f'Error storing war: {war}')
+                continue
+            prep_time = int(
+                war.preparation_start_time.time.replace(
+                    tzinfo=pend.UTC
+                ).timestamp()
+            )
+            war_unique_id = (
+                '-'.join(sorted([war.clan.tag, war.opponent.tag]))
+                + f'-{prep_time}'
+            )
+            custom_id = hashids.encode(
+                prep_time
+                + int(pend.now(tz=pend.UTC).timestamp())
+                + random.randint(1000000000, 9999999999)
+            )
+            changes.append(
+                UpdateOne(
+                    {'war_id': war_unique_id},
+                    {
+                        '$set': {
+                            'custom_id': custom_id,
+                            'data': war._raw_data,
+                            'type': war.type,
+                        }
+                    },
+                    upsert=True,
+                )
+            )
+        if changes:
+            await db_client.clan_wars.bulk_write(changes, ordered=False)
+        logger.info(f'Stored {len(changes)}/{len(jobs)} ended wars')
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.window)
+            if not self.pending:
+                continue
+            jobs, self.pending = self.pending, []
+            try:
+                await self.store_batch(jobs)
+            except Exception as e:
+                logger.error(f'Error storing ended wars: {e}')
 
 
 async def main():
-    scheduler = AsyncIOScheduler(timezone='UTC')
-    scheduler.start()
-    await store(scheduler=scheduler)
+    timers = TimerService(config.get_redis_client(), key='timers:war_store')
+    batcher = WarStoreBatcher(timers)
+    timers.register('war_store', batcher.add)
+    await asyncio.gather(timers.run(), batcher.run(), store(timers=timers))
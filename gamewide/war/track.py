@@ -1,8 +1,6 @@
 import asyncio
 import logging
 import random
-from datetime import datetime
-from typing import List
 
 import aiohttp
 import coc
@@ -11,16 +9,20 @@ import pendulum as pend
 from asyncio_throttle import Throttler
 from expiring_dict import ExpiringDict
 from hashids import Hashids
-from kafka import KafkaProducer
 from loguru import logger
-from msgspec import Struct
-from msgspec.json import decode
 from pymongo import InsertOne, UpdateOne
 
 from utility.classes import MongoDatabase
 from utility.keycreation import create_keys
+from utility.producer import AsyncKafkaProducer
 
+from .classes import war_decoder
 from .config import GlobalWarTrackingConfig
+from .predictor import WarStartPredictor
+from .registry import InWarRegistry
+
+# how long a war_timer doc is kept after its war ends
+WAR_TIMER_TTL = 7 * 86400
 
 config = GlobalWarTrackingConfig()
 db_client = MongoDatabase(
@@ -36,25 +38,44 @@ coc_client = coc.Client(
 )
 
 
-class Members(Struct):
-    tag: str
-
-
-class Clan(Struct):
-    tag: str
-    members: List[Members]
-
-
-class War(Struct):
-    state: str
-    preparationStartTime: str
-    endTime: str
-    clan: Clan
-    opponent: Clan
-
-
-async def broadcast():
-    in_war = ExpiringDict()
+async def broadcast(producer: AsyncKafkaProducer):
+    # clans already in a war aren't polled again until it ends
+    in_war = InWarRegistry(config.get_redis_client())
+    await in_war.refresh()
+    logger.info(f'{len(in_war)} clans in war at startup')
+    # clans not expected to start a war soon are polled sparsely
+    predictor = WarStartPredictor(db_client.clan_wars)
+    await predictor.load()
+
+    # war_timer holds one doc per war; a player's wars are found by member
+    # tag, and docs expire WAR_TIMER_TTL after their war ends
+    await db_client.war_timer.create_index('members')
+    await db_client.war_timer.create_index(
+        'time', expireAfterSeconds=WAR_TIMER_TTL
+    )
+    # the old one doc per player schema has no members field
+    legacy = await db_client.war_timer.delete_many(
+        {'members': {'$exists': False}}
+    )
+    if legacy.deleted_count:
+        logger.info(f'Removed {legacy.deleted_count} per player war_timer docs')
+    # war id -> True until the war ends, for wars whose clan_wars and
+    # war_timer docs are written already
+    captured = ExpiringDict()
+    pipeline = [
+        {
+            '$match': {
+                '$and': [
+                    {'endTime': {'$gte': int(pend.now(tz=pend.UTC).timestamp())}},
+                    {'data': {'$eq': None}},
+                ]
+            }
+        },
+        {'$group': {'_id': '$war_id', 'endTime': {'$max': '$endTime'}}},
+    ]
+    now = pend.now(tz=pend.UTC).timestamp()
+    async for result in db_client.clan_wars.aggregate(pipeline):
+        captured.ttl(result['_id'], True, max(result['endTime'] - now, 1))
 
     x = 1
     keys = await create_keys(
@@ -64,16 +85,23 @@ async def broadcast():
         ],
         [config.coc_password] * config.max_coc_email,
     )
-    producer = KafkaProducer(
-        bootstrap_servers=['85.10.200.219:9092'], api_version=(3, 6, 0)
-    )
-
     throttler = Throttler(rate_limit=1200, period=1)
     print(f'{len(list(keys))} keys')
     await coc_client.login_with_tokens(*list(keys))
 
     while True:
         api_fails = 0
+        try:
+            await in_war.refresh()
+        except Exception as e:
+            # the local copy from the last pass is still good enough to skip by
+            logger.error(f'Error refreshing in war registry: {e}')
+        predictor.skipped = 0
+        if x % 20 == 0:
+            try:
+                await predictor.load()
+            except Exception as e:
+                logger.error(f'Error loading war start predictions: {e}')
 
         async def fetch(
             url,
@@ -91,6 +119,8 @@ async def broadcast():
                     return (None, None)
 
         bot_clan_tags = await db_client.clans_db.distinct('tag')
+        # the bot's own clans are polled every pass, whatever the predictor says
+        bot_tag_set = set(bot_clan_tags)
         size_break = 50_000
 
         if x % 20 != 0:
@@ -117,7 +147,12 @@ async def broadcast():
 
             combined_tags = set(clan_tags + bot_clan_tags)
             all_tags = list(
-                [tag for tag in combined_tags if tag not in in_war]
+                [
+                    tag
+                    for tag in combined_tags
+                    if tag not in in_war
+                    and (tag in bot_tag_set or predictor.due(tag))
+                ]
             )
         else:
             pipeline = [
@@ -132,38 +167,22 @@ async def broadcast():
                     )
                 )
             ]
+            combined_tags = set(all_tags + bot_clan_tags)
             all_tags = [
-                tag for tag in all_tags if tag not in in_war
-            ] + bot_clan_tags
-            all_tags = list(set(all_tags))
+                tag
+                for tag in combined_tags
+                if tag not in in_war
+                and (tag in bot_tag_set or predictor.due(tag))
+            ]
 
-        logger.info(f'{len(all_tags)} tags')
+        logger.info(
+            f'{len(all_tags)} tags | {predictor.skipped} skipped until their expected war start'
+        )
         all_tags = [
             all_tags[i : i + size_break]
             for i in range(0, len(all_tags), size_break)
         ]
 
-        timers_alr_captured = set()
-        if x == 1:
-            right_now = datetime.now().timestamp()
-            one_week_ago = int(right_now)
-            pipeline = [
-                {
-                    '$match': {
-                        '$and': [
-                            {'endTime': {'$gte': one_week_ago}},
-                            {'data': {'$eq': None}},
-                        ]
-                    }
-                },
-                {'$group': {'_id': '$war_id'}},
-            ]
-            results = await db_client.clan_wars.aggregate(pipeline).to_list(
-                length=None
-            )
-            for result in results:
-                timers_alr_captured.add(result.get('_id'))
-
         x += 1
         for count, tag_group in enumerate(all_tags, 1):
             logger.info(f'Group {count}/{len(all_tags)}')
@@ -190,18 +209,28 @@ async def broadcast():
             responses = [r for r in responses if type(r) is tuple]
             changes = []
             war_timers = []
+            war_ends = {}
             for response, tag in responses:
                 # we shouldnt have completely invalid tags, they all existed at some point
                 if response is None or response == 403:
                     if response is None:
                         api_fails += 1
                     continue
+                # member lists stay raw until a war turns out to be new
                 try:
-                    war = decode(response, type=War)
+                    war = war_decoder.decode(response)
                 except:
                     continue
 
-                if war.state != 'notInWar':
+                if (
+                    war.state != 'notInWar'
+                    and war.clan is not None
+                    and war.opponent is not None
+                    and war.clan.tag
+                    and war.opponent.tag
+                    and war.endTime
+                    and war.preparationStartTime
+                ):
                     war_end = coc.Timestamp(data=war.endTime)
                     run_time = war_end.time.replace(tzinfo=pend.UTC)
                     if war_end.seconds_until < 0:
@@ -215,32 +244,39 @@ async def broadcast():
                         else war.clan.tag
                     )
 
-                    in_war.ttl(key=tag, value=True, ttl=war_end.seconds_until)
-                    in_war.ttl(
-                        key=opponent_tag, value=True, ttl=war_end.seconds_until
-                    )
+                    war_ends[tag] = run_time.timestamp()
+                    war_ends[opponent_tag] = run_time.timestamp()
+                    for clan_tag in (tag, opponent_tag):
+                        predictor.observe(
+                            clan_tag, war_prep.timestamp(), run_time.timestamp()
+                        )
 
                     war_unique_id = (
                         '-'.join(sorted([war.clan.tag, war.opponent.tag]))
                         + f'-{int(war_prep.timestamp())}'
                     )
-                    if war_unique_id not in timers_alr_captured:
-                        for member in war.clan.members + war.opponent.members:
-                            war_timers.append(
-                                UpdateOne(
-                                    {'_id': member.tag},
-                                    {
-                                        '$set': {
-                                            'clans': [
-                                                war.clan.tag,
-                                                war.opponent.tag,
-                                            ],
-                                            'time': war_end.time,
-                                        }
-                                    },
-                                    upsert=True,
-                                )
+                    if war_unique_id not in captured:
+                        # both clans of a war can be polled in the same pass
+                        captured.ttl(
+                            war_unique_id, True, war_end.seconds_until
+                        )
+                        war_timers.append(
+                            UpdateOne(
+                                {'_id': war_unique_id},
+                                {
+                                    '$set': {
+                                        'members': war.clan.member_tags()
+                                        + war.opponent.member_tags(),
+                                        'clans': [
+                                            war.clan.tag,
+                                            war.opponent.tag,
+                                        ],
+                                        'time': war_end.time,
+                                    }
+                                },
+                                upsert=True,
                             )
+                        )
 
                         changes.append(
                             InsertOne(
@@ -261,6 +297,11 @@ async def broadcast():
                         topic='war_store', value=orjson.dumps(json_data)
                     )
 
+            try:
+                await in_war.add(war_ends)
+            except Exception as e:
+                logger.error(f'Error updating in war registry: {e}')
+
             if changes:
                 try:
                     await db_client.clan_wars.bulk_write(
@@ -286,4 +327,9 @@ async def broadcast():
 
 
 async def main():
-    await broadcast()
+    producer = AsyncKafkaProducer()
+    await producer.start()
+    try:
+        await broadcast(producer)
+    finally:
+        await producer.stop()
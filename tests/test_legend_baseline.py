@@ -0,0 +1,41 @@
+import numpy as np
+
+from bot.legends.baseline import LegendBaseline
+
+
+def compare(baseline, trophies, attack_wins, defense_wins):
+    return baseline.compare(
+        ['#P'],
+        np.array([trophies], dtype=np.int32),
+        np.array([attack_wins], dtype=np.int32),
+        np.array([defense_wins], dtype=np.int32),
+    )
+
+
+def defenses_today(baseline):
+    return int(baseline.defenses_today[baseline.slots['#P']])
+
+
+def test_loss_with_defense_win_counts_one_defense():
+    baseline = LegendBaseline()
+    compare(baseline, 5000, 10, 20)
+
+    # one poll sees a lost defense and a won defense: the won defense is
+    # part of the defense wins delta, the loss is the other defense
+    compare(baseline, 4960, 10, 21)
+    assert defenses_today(baseline) == 1
+
+
+def test_loss_counts_one_defense():
+    baseline = LegendBaseline()
+    compare(baseline, 5000, 10, 20)
+    compare(baseline, 4960, 10, 20)
+    assert defenses_today(baseline) == 1
+
+
+def test_gain_counts_defense_wins_only():
+    baseline = LegendBaseline()
+    compare(baseline, 5000, 10, 20)
+    compare(baseline, 5040, 11, 22)
+    assert defenses_today(baseline) == 2
+    assert int(baseline.attacks_today[baseline.slots['#P']]) == 1
@@ -0,0 +1,140 @@
+import asyncio
+import copy
+import random
+
+import coc
+import orjson
+import pendulum as pend
+import pytest
+
+from benchmarks.war_diff import CLIENT, _time, make_war
+from benchmarks.player_diff import _tag
+from bot.war import utils
+
+
+class FakeRedis:
+    def __init__(self):
+        self.values = {}
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def set(self, key, value, ex=None):
+        self.values[key] = value
+
+
+class FakeProducer:
+    def __init__(self):
+        self.events = []
+
+    def send(self, topic, value, key=None, timestamp_ms=None):
+        self.events.append(orjson.loads(value))
+
+
+class FakeTimers:
+    async def schedule(self, *args, **kwargs):
+        pass
+
+
+class FakeReminders:
+    def reminders_for(self, clan_tag, seconds_left):
+        return []
+
+
+class FakeClient:
+    raw_attribute = True
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    async def get_clan_war(self, clan_tag):
+        return coc.ClanWar(
+            data=copy.deepcopy(self.raw), client=CLIENT, clan_tag=clan_tag
+        )
+
+
+def cwl_prep_war(rng):
+    raw = make_war(rng, size=15)
+    raw['state'] = 'preparation'
+    raw['tag'] = '#2PP'  # league wars carry their war tag
+    return raw
+
+
+def track(raw, producer, redis):
+    clan_tag = raw['clan']['tag']
+    return asyncio.run(
+        utils.clan_war_track(
+            clan_tag,
+            None,
+            FakeClient(raw),
+            producer,
+            redis,
+            FakeTimers(),
+            FakeReminders(),
+            None,
+        )
+    )
+
+
+def test_cwl_lineup_change_during_preparation():
+    utils.WAR_STATES.clear()
+    rng = random.Random(1)
+    raw = cwl_prep_war(rng)
+    producer, redis = FakeProducer(), FakeRedis()
+
+    track(raw, producer, redis)
+    assert producer.events == []
+
+    removed = raw['clan']['members'][-1]
+    added = dict(removed, tag=_tag(rng))
+    raw['clan']['members'][-1] = added
+    state, _, _ = track(raw, producer, redis)
+
+    assert state == 'preparation'
+    changes = [e for e in producer.events if e['type'] == 'cwl_lineup_change']
+    assert len(changes) == 1
+    assert changes[0]['clan_tag'] == raw['clan']['tag']
+    assert [m['tag'] for m in changes[0]['added']] == [added['tag']]
+    assert [m['tag'] for m in changes[0]['removed']] == [removed['tag']]
+
+
+def test_unchanged_cwl_lineup_sends_nothing():
+    utils.WAR_STATES.clear()
+    raw = cwl_prep_war(random.Random(2))
+    producer, redis = FakeProducer(), FakeRedis()
+
+    track(raw, producer, redis)
+    raw['clan']['clanLevel'] += 1  # a change that isn't the lineup
+    track(raw, producer, redis)
+    assert producer.events == []
+
+
+class FailingRedis(FakeRedis):
+    async def set(self, key, value, ex=None):
+        raise ConnectionError('redis down')
+
+
+def test_failed_payload_write_keeps_war_uncached():
+    utils.WAR_STATES.clear()
+    raw = cwl_prep_war(random.Random(3))
+    war = asyncio.run(FakeClient(raw).get_clan_war(raw['clan']['tag']))
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(utils.save_war(FailingRedis(), 'war-id', war, None, 0))
+    assert 'war-id' not in utils.WAR_STATES
+
+    asyncio.run(utils.save_war(FakeRedis(), 'war-id', war, None, 0))
+    assert 'war-id' in utils.WAR_STATES
+
+
+def test_preparation_reports_time_until_start():
+    utils.WAR_STATES.clear()
+    raw = cwl_prep_war(random.Random(4))
+    raw['startTime'] = _time(pend.now(tz=pend.UTC).add(seconds=120))
+
+    state, _, starts_in = track(raw, FakeProducer(), FakeRedis())
+    assert state == 'preparation'
+    assert 100 < starts_in <= 120
+
+    raw['state'] = 'inWar'
+    assert track(raw, FakeProducer(), FakeRedis())[2] is None
@@ -1,9 +1,11 @@
 import asyncio
-from collections import defaultdict, deque
+import time
+from collections import deque
 
 import aiohttp
 import coc
 import pendulum as pend
+import orjson
 import sentry_sdk
 import ujson
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
@@ -12,6 +14,7 @@ from loguru import logger
 from sentry_sdk.integrations.asyncio import AsyncioIntegration
 
 from utility.config import Config, TrackingType
+from utility.tracing import Tracer
 from utility.utils import sentry_filter
 
 
@@ -22,25 +25,33 @@ class Tracking:
         batch_size=500,
         throttle_speed=1000,
         tracker_type=TrackingType,
+        continuous=True,
+        worker_count=None,
     ):
         self.config = Config(config_type=tracker_type)
         self.db_client = None
         self.semaphore = asyncio.Semaphore(max_concurrent_requests)
         self.message_count = 0
+        self.message_bytes = 0
         self.iterations = 0
         self.batch_size = batch_size
+        # continuous mode keeps `worker_count` items in flight at all times
+        # instead of waiting for the slowest item of every batch
+        self.continuous = continuous
+        self.worker_count = worker_count or batch_size
+        self.loop_stats = {}
+        self.tracer = Tracer(sample_rate=self.config.tracing_sample_rate)
         self.throttler = Throttler(throttle_speed)
         self.coc_client = None
+        self.keys = deque()
         self.redis = None
         self.logger = logger
         self.http_session = None
         self.scheduler = None
         self.kafka = None
         self.type = tracker_type
-        self.max_stats_size = 10_000
-        self.request_stats = defaultdict(
-            lambda: deque(maxlen=self.max_stats_size)
-        )
+        # API requests made through fetch this loop
+        self.request_count = 0
 
     async def initialize(self):
         """Initialise the tracker with dependencies."""
@@ -48,8 +59,10 @@ class Tracking:
         self.db_client = self.config.get_mongo_database()
         self.redis = self.config.get_redis_client()
         self.coc_client = self.config.coc_client
+        self.keys = self.config.keys
 
         self.kafka = self.config.get_kafka_producer()
+        await self.kafka.start()
 
         connector = aiohttp.TCPConnector(limit=1200, ttl_dns_cache=300)
         timeout = aiohttp.ClientTimeout(total=1800)
@@ -60,8 +73,26 @@ class Tracking:
         self.scheduler = AsyncIOScheduler(timezone=pend.UTC)
 
     async def track(self, items):
-        """Track items in batches."""
+        """Track items with a pool of workers, or in batches."""
         self.message_count = 0  # Reset message count
+        self.message_bytes = 0
+        self.request_count = 0
+        if self.continuous:
+            self.loop_stats = await self._track_continuous(items)
+            self.loop_stats.update(self._loop_counters())
+            self.logger.info(
+                f"Tracked {self.loop_stats['items']} items with "
+                f'{self.worker_count} workers | '
+                f"{self.loop_stats['throughput']:.1f} items/s | "
+                f"p50 {self.loop_stats['p50']:.3f}s | "
+                f"p95 {self.loop_stats['p95']:.3f}s | "
+                f"p99 {self.loop_stats['p99']:.3f}s | "
+                f"max {self.loop_stats['max']:.3f}s"
+            )
+            self.kafka.log_stats()
+            self.tracer.finish_loop(str(self.type), self.loop_stats)
+            return
+
         for i in range(0, len(items), self.batch_size):
             batch = items[i : i + self.batch_size]
             print(
@@ -69,17 +100,17 @@ class Tracking:
             )
             await self._track_batch(batch)
 
-        sentry_sdk.add_breadcrumb(
-            message='Finished tracking all clans.', level='info'
-        )
+        self.tracer.finish_loop(str(self.type))
         print('Finished tracking all clans.')
 
+    def _loop_counters(self) -> dict:
+        """Per-loop counters added to the loop stats, trackers can add their own."""
+        return {'requests': self.request_count}
+
     async def fetch(self, url: str, tag: str, json=False):
         async with self.throttler:
             self.keys.rotate(1)
-            self.request_stats[url].append(
-                {'time': pend.now(tz=pend.UTC).timestamp()}
-            )
+            self.request_count += 1
             async with self.http_session.get(
                 url, headers={'Authorization': f'Bearer {self.keys[0]}'}
             ) as response:
@@ -89,10 +120,55 @@ class Tracking:
                     return (await response.json(), tag)
                 return (None, None)
 
+    async def _track_continuous(self, items):
+        """
+        Track items with a fixed pool of workers pulling from a shared queue.
+
+        A worker picks up the next item as soon as its current one finishes,
+        so one slow item holds up a single worker rather than the whole batch.
+        Returns throughput and per-item latency percentiles for the loop.
+        """
+        queue = deque(items)
+        latencies = []
+
+        async def worker():
+            while queue:
+                await self.kafka.backpressure()
+                item = queue.popleft()
+                start = time.perf_counter()
+                try:
+                    await self._traced_item(item)
+                except Exception as e:
+                    self._handle_exception('Error in tracking task', e)
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(worker() for _ in range(min(self.worker_count, len(items))))
+        )
+        elapsed = time.perf_counter() - start
+
+        latencies.sort()
+
+        def percentile(p):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+        return {
+            'items': len(latencies),
+            'seconds': elapsed,
+            'throughput': len(latencies) / elapsed if elapsed else 0.0,
+            'p50': percentile(0.50),
+            'p95': percentile(0.95),
+            'p99': percentile(0.99),
+            'max': latencies[-1] if latencies else 0.0,
+        }
+
     async def _track_batch(self, batch):
         """Track a batch of items."""
         async with self.semaphore:
-            tasks = [self._track_item(item) for item in batch]
+            tasks = [self._traced_item(item) for item in batch]
             results = await asyncio.gather(*tasks, return_exceptions=True)
 
             for result in results:
@@ -100,6 +176,10 @@ class Tracking:
                     self._handle_exception('Error in tracking task', result)
         print(f'Finished tracking batch of {len(batch)} clans.')  # Added print
 
+    async def _traced_item(self, item):
+        with self.tracer.item():
+            await self._track_item(item)
+
     async def _track_item(self, item):
         """Override this method in child classes."""
         raise NotImplementedError(
@@ -108,22 +188,12 @@ class Tracking:
 
     def _send_to_kafka(self, topic, key, data):
         """Helper to send data to Kafka."""
-        sentry_sdk.add_breadcrumb(
-            message=f'Sending data to Kafka: topic={topic}, key={key}',
-            data={
-                'data_preview': data
-                if self.config.is_beta
-                else 'Data suppressed in production'
-            },
-            level='info',
-        )
-        self.kafka.send(
-            topic=topic,
-            value=ujson.dumps(data).encode('utf-8'),
-            key=key.encode('utf-8'),
-            timestamp_ms=int(pend.now(tz=pend.UTC).timestamp() * 1000),
-        )
+        with self.tracer.span('emit'):
+            # aiokafka stamps the message with the send time
+            value = orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+            self.kafka.send(topic=topic, value=value, key=key.encode('utf-8'))
         self.message_count += 1
+        self.message_bytes += len(value)
 
     @staticmethod
     def _handle_exception(message, exception):
@@ -202,9 +272,11 @@ class Tracking:
 
         sentry_sdk.init(
             dsn=tracker.config.sentry_dsn,
-            traces_sample_rate=1.0,
+            # per-item timings go through tracker.tracer, Sentry only gets
+            # one aggregated transaction per loop plus errors
+            traces_sample_rate=tracker.config.sentry_traces_sample_rate,
             integrations=[AsyncioIntegration()],
-            profiles_sample_rate=1.0,
+            profiles_sample_rate=0.0,
             environment='production' if tracker.config.is_main else 'beta',
             before_send=sentry_filter,
         )
@@ -245,7 +317,8 @@ class Tracking:
                             tracker.logger.info(
                                 f'Tracked {len(clan_tags)} clans in {elapsed_time.in_seconds()} seconds. '
                                 f'Messages sent: {tracker.message_count} '
-                                f'({tracker.message_count / elapsed_time.in_seconds()} msg/s).'
+                                f'({tracker.message_count / elapsed_time.in_seconds()} msg/s, '
+                                f'{tracker.message_bytes / elapsed_time.in_seconds():.0f} bytes/s).'
                             )
                         else:
                             tracker.logger.info(
@@ -257,5 +330,6 @@ class Tracking:
         except SystemExit:
             tracker.logger.info('Shutting down...')
         finally:
+            await tracker.kafka.stop()
             await tracker.coc_client.close()
             tracker.logger.info('Execution completed.')
@@ -5,12 +5,12 @@ from os import getenv
 import coc
 import requests
 from dotenv import load_dotenv
-from kafka import KafkaProducer
 from redis import asyncio as redis
 
 from bot.dev.kafka_mock import MockKafkaProducer
 from utility.classes import MongoDatabase
 from utility.keycreation import create_keys
+from utility.producer import AsyncKafkaProducer
 
 # Load environment variables from .env file
 load_dotenv()
@@ -100,6 +100,18 @@ class Config:
         self.is_beta = remote_settings.get('is_beta', False)
         self.is_main = remote_settings.get('is_main', False)
         self.webhook_url = remote_settings.get('webhook_url')
+        self.sentry_traces_sample_rate = remote_settings.get(
+            'sentry_traces_sample_rate', 1.0
+        )
+        self.tracing_sample_rate = remote_settings.get(
+            'tracing_sample_rate', 0.01
+        )
+        self.clan_coalesced_events = remote_settings.get(
+            'clan_coalesced_events', False
+        )
+        self.clan_event_snapshots = remote_settings.get(
+            'clan_event_snapshots', True
+        )
 
         # Determine the account range based on config_type
         self.__beta_range = (7, 10)
@@ -150,9 +162,7 @@ class Config:
 
     def get_kafka_producer(self):
         if self.is_main:
-            return KafkaProducer(
-                bootstrap_servers=['85.10.200.219:9092'], api_version=(3, 6, 0)
-            )
+            return AsyncKafkaProducer()
         return MockKafkaProducer()
 
     def get_mongo_database(self):
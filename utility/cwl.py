@@ -0,0 +1,148 @@
+import asyncio
+import time
+from typing import Iterable, Optional
+
+import orjson
+import pendulum as pend
+
+# league groups are kept for the rest of the season after they are last seen
+GROUP_TTL = 14 * 86400
+# how soon a group that isn't tied to a round yet is fetched again
+DEFAULT_REFRESH = 3600
+
+
+def cwl_id(season: str, clan_tags: Iterable[str]) -> str:
+    """The id of a league group, the same one the cwl_group collection uses."""
+    tags = sorted(tag.replace('#', '') for tag in clan_tags)
+    return f"{season}-{'-'.join(tags)}"
+
+
+def cwl_season() -> str:
+    """The season of the CWL running now, as the API names it."""
+    return pend.now(tz=pend.UTC).format('YYYY-MM')
+
+
+class LeagueGroupCache:
+    """
+    CWL league groups in Redis, one entry per group and season.
+
+    An entry is stored once under its `cwl_id` and every clan of the group
+    points to it from the season index, so the 8 clans of a group share a
+    single league group fetch. An entry is
+    `{'group': raw group, 'war_tags': {round: {clan tag: war tag}}, 'refresh_at': ts}`;
+    the war tags of a round are mapped to clans once, the first time any
+    clan of the group needs that round, and `refresh_at` is when the group
+    should be fetched again, i.e. when its next round starts. None means the
+    group won't change anymore.
+    """
+
+    def __init__(self, redis, ttl: int = GROUP_TTL):
+        self.redis = redis
+        self.ttl = ttl
+        self._locks: dict[str, asyncio.Lock] = {}
+
+    @staticmethod
+    def group_key(group_id: str) -> str:
+        return f'cwl:group:{group_id}'
+
+    @staticmethod
+    def index_key(season: str) -> str:
+        return f'cwl:index:{season}'
+
+    def lock(self, group_id: str) -> asyncio.Lock:
+        """Serializes round mapping for a group so its clans don't repeat it."""
+        return self._locks.setdefault(group_id, asyncio.Lock())
+
+    async def get(self, clan_tag: str, season: str = None) -> Optional[dict]:
+        entries = await self.get_many([clan_tag], season=season)
+        return entries.get(clan_tag)
+
+    async def get_many(
+        self, clan_tags: list[str], season: str = None
+    ) -> dict[str, dict]:
+        """The cached entries of the clans that have one, by clan tag."""
+        season = season or cwl_season()
+        if not clan_tags:
+            return {}
+        group_ids = await self.redis.hmget(self.index_key(season), clan_tags)
+        found = {
+            tag: group_id.decode() if isinstance(group_id, bytes) else group_id
+            for tag, group_id in zip(clan_tags, group_ids)
+            if group_id is not None
+        }
+        unique_ids = list(set(found.values()))
+        if not unique_ids:
+            return {}
+        raw_entries = await self.redis.mget(
+            [self.group_key(group_id) for group_id in unique_ids]
+        )
+        entries = {
+            group_id: orjson.loads(raw)
+            for group_id, raw in zip(unique_ids, raw_entries)
+            if raw is not None
+        }
+        return {
+            tag: entries[group_id]
+            for tag, group_id in found.items()
+            if group_id in entries
+        }
+
+    @staticmethod
+    def is_due(entry: dict) -> bool:
+        refresh_at = entry.get('refresh_at')
+        return refresh_at is not None and refresh_at <= time.time()
+
+    async def put(
+        self,
+        group: dict,
+        war_tags: dict = None,
+        refresh_at: float = None,
+    ) -> dict:
+        """
+        Store a freshly fetched group and index all of its clans.
+
+        Round to war tag mappings already known for the group are kept.
+        Without a `refresh_at` an ended group is never refreshed and any
+        other group after DEFAULT_REFRESH seconds.
+        """
+        season = group.get('season') or cwl_season()
+        clan_tags = [clan['tag'] for clan in group.get('clans', [])]
+        group_id = cwl_id(season, clan_tags)
+
+        if war_tags is None:
+            raw = await self.redis.get(self.group_key(group_id))
+            war_tags = orjson.loads(raw)['war_tags'] if raw is not None else {}
+        if refresh_at is None and group.get('state') != 'ended':
+            refresh_at = time.time() + DEFAULT_REFRESH
+
+        entry = {'group': group, 'war_tags': war_tags, 'refresh_at': refresh_at}
+        await self._write(season, group_id, clan_tags, entry)
+        return entry
+
+    async def update(self, entry: dict, **fields) -> dict:
+        """Write back an entry with some of its fields changed."""
+        entry = {**entry, **fields}
+        group = entry['group']
+        season = group.get('season') or cwl_season()
+        clan_tags = [clan['tag'] for clan in group.get('clans', [])]
+        await self._write(season, self.id_of(entry), clan_tags, entry)
+        return entry
+
+    @staticmethod
+    def id_of(entry: dict) -> str:
+        group = entry['group']
+        return cwl_id(
+            group.get('season') or cwl_season(),
+            [clan['tag'] for clan in group.get('clans', [])],
+        )
+
+    async def _write(
+        self, season: str, group_id: str, clan_tags: list[str], entry: dict
+    ):
+        index_key = self.index_key(season)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.set(self.group_key(group_id), orjson.dumps(entry), ex=self.ttl)
+            if clan_tags:
+                pipe.hset(index_key, mapping={tag: group_id for tag in clan_tags})
+                pipe.expire(index_key, self.ttl)
+            await pipe.execute()
@@ -0,0 +1,139 @@
+import asyncio
+import time
+from collections import defaultdict, deque
+
+from aiokafka import AIOKafkaProducer
+from loguru import logger
+
+KAFKA_SERVERS = ['85.10.200.219:9092']
+
+
+class AsyncKafkaProducer:
+    """
+    Shared aiokafka producer for the trackers.
+
+    `send` keeps the kafka-python signature and is synchronous: it only
+    appends to an in-memory buffer, which a background task hands to
+    aiokafka. aiokafka batches per partition for `linger_ms` or until
+    `max_batch_size` bytes and compresses each batch. Callers in hot loops
+    should `await backpressure()` now and then, which waits while the
+    buffer is over `max_buffered` messages.
+    """
+
+    def __init__(
+        self,
+        bootstrap_servers=None,
+        linger_ms: int = 50,
+        max_batch_size: int = 512 * 1024,
+        compression_type: str = 'lz4',
+        max_buffered: int = 50_000,
+        **kwargs,
+    ):
+        self.config = dict(
+            bootstrap_servers=bootstrap_servers or KAFKA_SERVERS,
+            linger_ms=linger_ms,
+            max_batch_size=max_batch_size,
+            compression_type=compression_type,
+            **kwargs,
+        )
+        self.max_buffered = max_buffered
+        self.producer = None
+        self.buffer = deque()
+        self.failed = 0
+        self.topic_stats = defaultdict(lambda: {'messages': 0, 'bytes': 0})
+        self.stats_since = time.monotonic()
+        self._task = None
+        self._pending = None
+        self._drained = None
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.buffer)
+
+    async def start(self):
+        # aiokafka binds to the running loop, so it is built here and not in __init__
+        self.producer = AIOKafkaProducer(**self.config)
+        await self.producer.start()
+        self._pending = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._task = asyncio.create_task(self._drain())
+
+    def send(self, topic, value=None, key=None, timestamp_ms=None):
+        self.buffer.append((topic, value, key, timestamp_ms))
+        stats = self.topic_stats[topic]
+        stats['messages'] += 1
+        stats['bytes'] += len(value or b'')
+        if self._pending is not None:
+            self._pending.set()
+            if len(self.buffer) >= self.max_buffered:
+                self._drained.clear()
+
+    async def backpressure(self):
+        """Wait until the buffer is back under `max_buffered` messages."""
+        if self._drained is not None:
+            await self._drained.wait()
+
+    async def _drain(self):
+        while True:
+            await self._pending.wait()
+            self._pending.clear()
+            while self.buffer:
+                topic, value, key, timestamp_ms = self.buffer.popleft()
+                try:
+                    # resolves once the message is in aiokafka's batch, and
+                    # blocks there if aiokafka's own buffer is full
+                    delivery = await self.producer.send(
+                        topic, value=value, key=key, timestamp_ms=timestamp_ms
+                    )
+                    delivery.add_done_callback(self._delivered)
+                except Exception as e:
+                    self.failed += 1
+                    logger.error(f'Kafka send to {topic} failed: {e}')
+                if len(self.buffer) < self.max_buffered // 2:
+                    self._drained.set()
+            self._drained.set()
+
+    def _delivered(self, delivery: asyncio.Future):
+        if delivery.cancelled() or delivery.exception() is not None:
+            self.failed += 1
+
+    async def flush(self):
+        """Wait until everything buffered has been delivered."""
+        while self.buffer:
+            await asyncio.sleep(0.01)
+        await self.producer.flush()
+
+    async def stop(self):
+        await self.flush()
+        self._task.cancel()
+        await self.producer.stop()
+
+    def stats(self) -> dict:
+        """Per-topic send rates since the last call, plus queue depth."""
+        now = time.monotonic()
+        elapsed = max(now - self.stats_since, 1e-9)
+        stats = {
+            'queue_depth': self.queue_depth,
+            'failed': self.failed,
+            'topics': {
+                topic: {
+                    'messages_per_sec': counts['messages'] / elapsed,
+                    'bytes_per_sec': counts['bytes'] / elapsed,
+                }
+                for topic, counts in self.topic_stats.items()
+            },
+        }
+        self.topic_stats.clear()
+        self.stats_since = now
+        return stats
+
+    def log_stats(self):
+        stats = self.stats()
+        topics = ', '.join(
+            f"{topic} {s['messages_per_sec']:.1f} msg/s {s['bytes_per_sec'] / 1024:.1f} KiB/s"
+            for topic, s in stats['topics'].items()
+        )
+        logger.info(
+            f"Kafka | queue {stats['queue_depth']} | failed {stats['failed']} | {topics or 'idle'}"
+        )
@@ -0,0 +1,209 @@
+import asyncio
+import time
+from collections import defaultdict
+from typing import Awaitable, Callable, Optional
+
+from loguru import logger
+from msgspec import msgpack
+
+# ZREM a job only if its score is still the fire time it was loaded with
+CLAIM_SCRIPT = """
+local score = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if score and tonumber(score) == tonumber(ARGV[2]) then
+    return redis.call('ZREM', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+
+class TimerService:
+    """
+    Durable one-shot timers backed by a Redis sorted set.
+
+    Every job is a member of the `key` sorted set, scored by its fire time,
+    with its kind and arguments in the `{key}:jobs` hash, so pending jobs
+    survive a restart. Jobs due within `lookahead` seconds are also kept
+    in an in-memory hashed timer wheel of `tick` second slots; each tick
+    fires the jobs whose slot came up, grouped by kind, so a handler gets
+    every job of its kind that came due together.
+
+    A job id is unique: scheduling an existing id moves it instead of
+    adding a second job. A job is claimed with ZREM, only while its score
+    is still the fire time it was loaded with, before it is fired, so with
+    several instances on the same key each job fires once and a moved job
+    fires at its new time. A job
+    claimed by a process that dies before its handler runs is lost.
+    """
+
+    def __init__(
+        self,
+        redis,
+        key: str = 'timers',
+        tick: float = 1.0,
+        lookahead: int = 300,
+    ):
+        self.redis = redis
+        self.key = key
+        self.jobs_key = f'{key}:jobs'
+        self.tick = tick
+        self.lookahead = lookahead
+        self.slots = int(lookahead / tick) + 2
+        self.wheel: list[dict[str, float]] = [{} for _ in range(self.slots)]
+        self.in_wheel: dict[str, int] = {}  # job id -> slot
+        self.handlers: dict[str, Callable[[list], Awaitable]] = {}
+        self.fired = 0
+        self._running = set()
+
+    def register(self, kind: str, handler: Callable[[list], Awaitable]):
+        """`handler` is awaited with the list of args of every due job of `kind`."""
+        self.handlers[kind] = handler
+
+    def _slot(self, fire_at: float) -> int:
+        return int(fire_at // self.tick) % self.slots
+
+    def _add_to_wheel(self, job_id: str, fire_at: float):
+        self._remove_from_wheel(job_id)
+        # overdue jobs go in the slot of the next tick
+        slot = self._slot(max(fire_at, time.time()))
+        self.wheel[slot][job_id] = fire_at
+        self.in_wheel[job_id] = slot
+
+    def _remove_from_wheel(self, job_id: str):
+        slot = self.in_wheel.pop(job_id, None)
+        if slot is not None:
+            self.wheel[slot].pop(job_id, None)
+
+    async def schedule(
+        self,
+        job_id: str,
+        kind: str,
+        fire_at: float,
+        args: list,
+        grace: Optional[int] = None,
+    ):
+        """
+        Schedule (or reschedule) `job_id` to fire at the `fire_at` timestamp.
+
+        A job found more than `grace` seconds late, e.g. after downtime, is
+        dropped instead of fired. None fires it however late it is.
+        """
+        job = msgpack.encode({'kind': kind, 'args': args, 'grace': grace})
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zadd(self.key, {job_id: fire_at})
+            pipe.hset(self.jobs_key, job_id, job)
+            await pipe.execute()
+        if fire_at <= time.time() + self.lookahead:
+            self._add_to_wheel(job_id, fire_at)
+        else:
+            # moved out of the lookahead, load() brings it back in time
+            self._remove_from_wheel(job_id)
+
+    async def cancel(self, job_id: str):
+        self._remove_from_wheel(job_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zrem(self.key, job_id)
+            pipe.hdel(self.jobs_key, job_id)
+            await pipe.execute()
+
+    async def load(self):
+        """Pull the jobs due within the lookahead from Redis into the wheel."""
+        due = await self.redis.zrangebyscore(
+            self.key, '-inf', time.time() + self.lookahead, withscores=True
+        )
+        for job_id, fire_at in due:
+            if isinstance(job_id, bytes):
+                job_id = job_id.decode()
+            slot = self.in_wheel.get(job_id)
+            # also picks up jobs another instance moved since the last load
+            if slot is None or self.wheel[slot].get(job_id) != fire_at:
+                self._add_to_wheel(job_id, fire_at)
+        return len(due)
+
+    async def _fire(self, due: dict[str, float]):
+        """Claim and run the jobs in `due` (job id -> fire time)."""
+        now = time.time()
+        job_ids = list(due)
+        # a job rescheduled since it was put in the wheel, possibly by
+        # another instance, has a new score and must not fire at the old time
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for job_id in job_ids:
+                pipe.eval(CLAIM_SCRIPT, 1, self.key, job_id, repr(due[job_id]))
+            claimed = [
+                job_id
+                for job_id, removed in zip(job_ids, await pipe.execute())
+                if removed
+            ]
+        if not claimed:
+            return
+
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hmget(self.jobs_key, claimed)
+            pipe.hdel(self.jobs_key, *claimed)
+            jobs, _ = await pipe.execute()
+
+        batches = defaultdict(list)
+        for job_id, job in zip(claimed, jobs):
+            fire_at = due[job_id]
+            if job is None:
+                continue
+            job = msgpack.decode(job)
+            if job['grace'] is not None and now - fire_at > job['grace']:
+                logger.warning(
+                    f'Timer {job_id} dropped, {now - fire_at:.0f}s late'
+                )
+                continue
+            batches[job['kind']].append(job['args'])
+
+        for kind, batch in batches.items():
+            handler = self.handlers.get(kind)
+            if handler is None:
+                logger.error(
+                    f'No timer handler for {kind}, dropped {len(batch)} jobs'
+                )
+                continue
+            self.fired += len(batch)
+            # handlers run in their own task so a slow batch doesn't hold up the wheel
+            task = asyncio.create_task(self._run_handler(kind, handler, batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    @staticmethod
+    async def _run_handler(kind: str, handler, batch: list):
+        try:
+            await handler(batch)
+        except Exception as e:
+            logger.error(f'Timer handler {kind} failed: {e}')
+
+    async def run(self):
+        """Load from Redis, then fire due jobs every tick."""
+        await self.load()
+        last_load = time.time()
+        current = self._slot(time.time())
+        while True:
+            await asyncio.sleep(self.tick)
+            now = time.time()
+            if now - last_load >= self.lookahead / 2:
+                try:
+                    await self.load()
+                except Exception as e:
+                    logger.error(f'Error loading timers: {e}')
+                last_load = now
+
+            due = {}
+            target = self._slot(now)
+            while True:
+                slot = self.wheel[current]
+                for job_id, fire_at in list(slot.items()):
+                    if fire_at <= now:
+                        del slot[job_id]
+                        del self.in_wheel[job_id]
+                        due[job_id] = fire_at
+                if current == target:
+                    break
+                current = (current + 1) % self.slots
+
+            if due:
+                try:
+                    await self._fire(due)
+                except Exception as e:
+                    logger.error(f'Error firing timers: {e}')
@@ -0,0 +1,87 @@
+import random
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import sentry_sdk
+
+_sampled: ContextVar[bool] = ContextVar('tracing_sampled', default=False)
+
+
+class Tracer:
+    """
+    Span timings for tracker loops, sampled per item and aggregated in process.
+
+    A worker wraps each item in `item()`, which decides once whether the item
+    is sampled. `span(name)` inside the item only times sampled items, so
+    unsampled items pay a context var lookup per span. At the end of a loop
+    `finish_loop` reduces the timings to count/mean/p95/max per span and
+    sends them to Sentry as a single transaction with measurements.
+    """
+
+    def __init__(self, sample_rate: float = 0.01, enabled: bool = True):
+        self.sample_rate = sample_rate
+        self.enabled = enabled
+        self.spans = defaultdict(list)
+        self.items = 0
+        self.sampled_items = 0
+
+    @contextmanager
+    def item(self):
+        self.items += 1
+        sampled = self.enabled and random.random() < self.sample_rate
+        token = _sampled.set(sampled)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if sampled:
+                self.sampled_items += 1
+                self.spans['item'].append(time.perf_counter() - start)
+            _sampled.reset(token)
+
+    @contextmanager
+    def span(self, name: str):
+        if not _sampled.get():
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans[name].append(time.perf_counter() - start)
+
+    def aggregate(self) -> dict:
+        aggregates = {}
+        for name, timings in self.spans.items():
+            timings.sort()
+            aggregates[name] = {
+                'count': len(timings),
+                'mean': sum(timings) / len(timings),
+                'p95': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+                'max': timings[-1],
+            }
+        return aggregates
+
+    def finish_loop(self, name: str, loop_stats: dict = None) -> dict:
+        """Send this loop's aggregates to Sentry and start a new loop."""
+        aggregates = self.aggregate()
+        if self.enabled:
+            with sentry_sdk.start_transaction(
+                op='tracking.loop', name=name
+            ) as transaction:
+                transaction.set_data('items', self.items)
+                transaction.set_data('sampled_items', self.sampled_items)
+                for key, value in (loop_stats or {}).items():
+                    transaction.set_data(key, value)
+                for span, stats in aggregates.items():
+                    transaction.set_data(f'{span}.count', stats['count'])
+                    for stat in ('mean', 'p95', 'max'):
+                        transaction.set_measurement(
+                            f'{span}.{stat}', stats[stat] * 1000, 'millisecond'
+                        )
+        self.spans.clear()
+        self.items = 0
+        self.sampled_items = 0
+        return aggregates
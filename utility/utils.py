@@ -1,3 +1,7 @@
+import coc
+import pendulum as pend
+
+
 def sentry_filter(event, hint):
     """Filter out events that are not errors."""
     if 'exception' in hint:
@@ -5,3 +9,39 @@ def sentry_filter(event, hint):
         if exc_type == KeyboardInterrupt:
             return None
     return event
+
+
+def gen_raid_date():
+    now = pend.now(tz=pend.UTC)
+    current_dayofweek = now.day_of_week  # Monday = 0, Sunday = 6
+    if (
+        (current_dayofweek == 4 and now.hour >= 7)  # Friday after 7 AM UTC
+        or (current_dayofweek == 5)  # Saturday
+        or (current_dayofweek == 6)  # Sunday
+        or (current_dayofweek == 0 and now.hour < 7)  # Monday before 7 AM UTC
+    ):
+        raid_date = now.subtract(
+            days=(current_dayofweek - 4 if current_dayofweek >= 4 else 0)
+        ).date()
+    else:
+        forward = 4 - current_dayofweek  # Days until next Friday
+        raid_date = now.add(days=forward).date()
+    return str(raid_date)
+
+
+def gen_season_date():
+    end = coc.utils.get_season_end().astimezone(pend.UTC)
+    month = f'{end.month:02}'
+    return f'{end.year}-{month}'
+
+
+def gen_legend_date():
+    now = pend.now(tz=pend.UTC)
+    date = now.subtract(days=1).date() if now.hour < 5 else now.date()
+    return str(date)
+
+
+def gen_games_season():
+    now = pend.now(tz=pend.UTC)
+    month = f'{now.month:02}'  # Ensure two-digit month
+    return f'{now.year}-{month}'